@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+'''
+Compares the EC2 inventory cache formats
+========================================
+
+Writes the cache of the inventory of a synthetic fleet (see
+benchmarks/fake_aws.py) in each of the cache formats supported by
+hosts/ec2.py ('json' and 'compact') and measures, each in a fresh process,
+how long it takes and how much memory (peak RSS) it costs to:
+
+ - write the cached inventory out for --list
+ - look up a single host's variables for --host
+ - look up a single group
+
+The peak RSS includes importing ec2.py and its dependencies, which is the
+same for every format.
+
+Usage:
+
+    python benchmarks/ec2_cache.py [--hosts 1000,10000]
+
+Requires the same packages as hosts/ec2.py (see requirements.txt), but makes
+no AWS calls.
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+from fake_aws import get_ec2_inventory, load_ec2_inventory, make_fleet, peak_rss
+
+FORMATS = ['json', 'compact']
+OPERATIONS = ['list', 'host', 'group']
+REGION = 'us-east-1'
+
+
+def get_inventory(cache_dir, cache_format):
+    ''' Creates an Ec2Inventory that only knows where its cache is, without
+    reading ec2.ini or calling AWS '''
+
+    module = load_ec2_inventory()
+    inventory = module.Ec2Inventory.__new__(module.Ec2Inventory)
+    inventory.cache_format = cache_format
+    for name in ['cache', 'index']:
+        setattr(inventory, 'cache_path_' + name, os.path.join(cache_dir, 'ansible-ec2.' + name))
+    return inventory
+
+
+def make_inventory(count):
+    ''' Builds the inventory hosts/ec2.py generates, with the settings in
+    ec2.ini, for a synthetic fleet of count instances '''
+
+    builder = get_ec2_inventory()
+    for instance in make_fleet(count, REGION):
+        record = builder.get_instance_record(instance, REGION)
+        if record:
+            builder.add_instance_record(record)
+    return builder.inventory
+
+
+def measure(cache_dir, cache_format, operation, name):
+    ''' Runs one operation against an existing cache and prints the time it
+    took (in ms) and the peak RSS of the process (in KB) '''
+
+    inventory = get_inventory(cache_dir, cache_format)
+
+    start = time()
+    if operation == 'list':
+        with open(os.devnull, 'w') as sink:
+            inventory.write_inventory_from_cache(sink)
+    elif operation == 'host':
+        assert inventory.get_cached_record('hosts', name) is not None
+    else:
+        assert inventory.get_cached_record('groups', name) is not None
+    elapsed = (time() - start) * 1000
+
+    print('%.2f %d' % (elapsed, peak_rss()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare EC2 inventory cache formats')
+    parser.add_argument('--hosts', default='1000,10000',
+                        help='Comma separated inventory sizes (default: 1000,10000)')
+    parser.add_argument('--measure', nargs=4, metavar=('CACHE_DIR', 'FORMAT', 'OPERATION', 'NAME'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(*args.measure)
+        return
+
+    print('%-8s %-8s %-6s %12s %10s %14s' % ('HOSTS', 'FORMAT', 'OP', 'CACHE (KB)', 'TIME (ms)', 'PEAK RSS (KB)'))
+    for count in [int(c) for c in args.hosts.split(',')]:
+        inventory = make_inventory(count)
+        hosts = sorted(inventory['_meta']['hostvars'])
+        host = hosts[len(hosts) // 2]
+
+        for cache_format in FORMATS:
+            cache_dir = tempfile.mkdtemp()
+            try:
+                writer = get_inventory(cache_dir, cache_format)
+                if cache_format == 'compact':
+                    writer.write_compact_cache(inventory)
+                else:
+                    writer.write_to_cache(inventory, writer.cache_path_cache)
+                size = sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir)) // 1024
+
+                for operation in OPERATIONS:
+                    name = host if operation == 'host' else 'tag_Group_web_server_dev'
+                    output = subprocess.check_output([sys.executable, __file__, '--measure',
+                                                      cache_dir, cache_format, operation, name])
+                    elapsed, rss = output.decode('utf-8').split()
+                    print('%-8d %-8s %-6s %12d %10s %14s' % (count, cache_format, operation, size, elapsed, rss))
+            finally:
+                shutil.rmtree(cache_dir)
+
+
+if __name__ == '__main__':
+    main()
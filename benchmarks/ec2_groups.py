@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+'''
+Measures the cost per instance of building the EC2 inventory
+============================================================
+
+Once the API calls of a refresh are made concurrently, most of the time
+left is spent by hosts/ec2.py working out the groups and host variables of
+every instance. This runs those steps over the instances of a synthetic
+fleet (see benchmarks/fake_aws.py), with the settings in hosts/ec2.ini, and
+prints how long each takes per instance:
+
+ - record: get_instance_record (host name, group names, host variables)
+ - sort:   ordering the records by launch time
+ - add:    add_instance_record (adding the records to the inventory)
+
+Usage:
+
+    python benchmarks/ec2_groups.py [--instances 1000,10000] [--repeat 3]
+
+Requires the same packages as hosts/ec2.py (see requirements.txt), but makes
+no AWS calls.
+'''
+
+import argparse
+from time import time
+
+from fake_aws import get_ec2_inventory, make_fleet
+
+REGION = 'us-east-1'
+
+
+def measure(instances, repeat):
+    ''' Returns the best time over repeat runs of each step, in
+    microseconds per instance '''
+
+    best = {}
+    for _ in range(repeat):
+        inventory = get_ec2_inventory()
+        timings = {}
+
+        start = time()
+        records = [inventory.get_instance_record(instance, REGION) for instance in instances]
+        timings['record'] = time() - start
+
+        start = time()
+        records = sorted([record for record in records if record],
+                         key=lambda x: inventory.get_launch_time_key(x['launch_time']), reverse=True)
+        timings['sort'] = time() - start
+
+        start = time()
+        for record in records:
+            inventory.add_instance_record(record)
+        timings['add'] = time() - start
+
+        timings['total'] = sum(timings.values())
+        for step, elapsed in timings.items():
+            best[step] = min(best.get(step, elapsed), elapsed)
+
+    return dict((step, elapsed * 1e6 / len(instances)) for step, elapsed in best.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost per instance of building the EC2 inventory')
+    parser.add_argument('--instances', default='1000,10000',
+                        help='Comma separated numbers of instances (default: 1000,10000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs to take the best of (default: 3)')
+    args = parser.parse_args()
+
+    steps = ['record', 'sort', 'add', 'total']
+    print('%-10s' % 'INSTANCES' + ''.join('%14s' % ('%s (us)' % step.upper()) for step in steps))
+    for count in [int(c) for c in args.instances.split(',')]:
+        timings = measure(make_fleet(count, REGION), args.repeat)
+        print('%-10d' % count + ''.join('%14.1f' % timings[step] for step in steps))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks hosts/ec2.py against a synthetic fleet
+=================================================
+
+Runs hosts/ec2.py, with the settings in hosts/ec2.ini, against the local
+stand-ins for AWS in benchmarks/fake_aws.py, for fleets of 100, 1000 and
+10000 instances per region, and reports for each of:
+
+ - refresh: --refresh-cache, a full refresh making all the API calls
+ - list:    --list answered from the cache
+ - host:    --host answered from the cache
+
+the wall time, the number of API calls, the peak RSS of the process and the
+size of the cache files.
+
+Every run is a fresh process. The wall time runs from starting hosts/ec2.py
+to it finishing, which includes importing it, but not starting Python or
+generating the fleet. Every API call waits --latency seconds, as a round trip
+to AWS would.
+
+Usage:
+
+    python benchmarks/ec2_inventory.py [--fleets 100,1000,10000] [--latency 0.05]
+                                       [--services] [--json FILE]
+
+--services also turns on Route53, RDS and ElastiCache, in two regions.
+
+Needs no AWS account or network, so it can run in CI: it exits with a
+non-zero status if hosts/ec2.py fails, and --json writes the results so that
+they can be compared between runs. benchmarks/smoke.sh runs it, and the other
+benchmarks, on a small fleet without latency for that.
+'''
+
+import argparse
+import json
+import os
+import re
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import time
+
+import fake_aws
+from fake_aws import EC2_INI, EC2_PY, peak_rss
+
+OPERATIONS = ['refresh', 'list', 'host']
+REGIONS = ['us-east-1', 'us-west-2']
+
+
+def write_settings(cache_dir, services):
+    ''' Writes a copy of ec2.ini that keeps its cache, and fact cache, in
+    cache_dir and does not use an inventory daemon, and returns its path '''
+
+    with open(EC2_INI) as ini_file:
+        settings = ini_file.read()
+
+    replacements = [('cache_path', cache_dir), ('fact_cache_path', os.path.join(cache_dir, 'facts')),
+                    ('daemon_socket', None)]
+    if services:
+        replacements.extend([('regions', ','.join(REGIONS)), ('route53', 'True'),
+                             ('rds', 'True'), ('elasticache', 'True')])
+    for (option, value) in replacements:
+        line = '# %s =' % option if value is None else '%s = %s' % (option, value)
+        settings = re.sub(r'(?m)^%s = .*$' % option, line, settings)
+
+    ini_path = os.path.join(cache_dir, 'ec2.ini')
+    with open(ini_path, 'w') as ini_file:
+        ini_file.write(settings)
+    return ini_path
+
+
+def measure(ini_path, count, latency, regions, operation, host):
+    ''' Runs hosts/ec2.py once against a generated fleet and prints how long
+    it took, the API calls it made and the peak RSS of the process '''
+
+    fake_aws.install(count, latency, regions)
+
+    os.environ['EC2_INI_PATH'] = ini_path
+    if operation == 'refresh':
+        sys.argv = [EC2_PY, '--refresh-cache']
+    else:
+        # Use the cache written by the refresh, however old
+        os.environ['EC2_CACHE_MAX_AGE'] = str(10 ** 9)
+        sys.argv = [EC2_PY, '--host', host] if operation == 'host' else [EC2_PY, '--list']
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        start = time()
+        runpy.run_path(EC2_PY, run_name='__main__')
+        elapsed = time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    print(json.dumps({'time': elapsed, 'calls': dict(fake_aws.CALLS), 'rss': peak_rss()}))
+
+
+def run(ini_path, count, latency, regions, operation, host=''):
+    ''' Measures an operation in a fresh process '''
+
+    output = subprocess.check_output([sys.executable, __file__, '--measure', ini_path, str(count),
+                                      str(latency), ','.join(regions), operation, host])
+    return json.loads(output.decode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark hosts/ec2.py against a synthetic fleet')
+    parser.add_argument('--fleets', default='100,1000,10000',
+                        help='Comma separated numbers of instances per region (default: 100,1000,10000)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Seconds every API call takes (default: 0.05)')
+    parser.add_argument('--services', action='store_true', default=False,
+                        help='Also turn on Route53, RDS and ElastiCache, in %s' % ' and '.join(REGIONS))
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--measure', nargs=6, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        (ini_path, count, latency, regions, operation, host) = args.measure
+        measure(ini_path, int(count), float(latency), regions.split(','), operation, host)
+        return
+
+    regions = REGIONS if args.services else REGIONS[:1]
+    results = []
+    print('%-8s %-8s %10s %10s %14s %12s' % ('FLEET', 'OP', 'TIME (s)', 'API CALLS', 'PEAK RSS (MB)', 'CACHE (KB)'))
+    for count in [int(c) for c in args.fleets.split(',')]:
+        cache_dir = tempfile.mkdtemp()
+        try:
+            ini_path = write_settings(cache_dir, args.services)
+            host = ''
+            for operation in OPERATIONS:
+                if operation == 'host':
+                    # The index lists every host, whatever the cache format
+                    with open(os.path.join(cache_dir, 'ansible-ec2.index')) as index:
+                        hosts = sorted(json.load(index))
+                    host = hosts[len(hosts) // 2]
+
+                try:
+                    result = run(ini_path, count, args.latency, regions, operation, host)
+                except subprocess.CalledProcessError:
+                    sys.exit('hosts/ec2.py failed: %s for a fleet of %d' % (operation, count))
+
+                result['cache'] = sum(os.path.getsize(os.path.join(cache_dir, f))
+                                      for f in os.listdir(cache_dir) if f.startswith('ansible-ec2.'))
+                result.update({'fleet': count, 'regions': regions, 'operation': operation})
+                results.append(result)
+
+                print('%-8d %-8s %10.2f %10d %14.1f %12d' % (count, operation, result['time'],
+                                                            sum(result['calls'].values()),
+                                                            result['rss'] / 1024.0, result['cache'] // 1024))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
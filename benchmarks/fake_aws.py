@@ -0,0 +1,362 @@
+'''
+Local stand-ins for the AWS connections hosts/ec2.py makes
+==========================================================
+
+install() replaces the boto functions hosts/ec2.py uses to connect to EC2,
+RDS, ElastiCache and Route53 with ones that return fake connections. These
+answer from a generated fleet of instances, count every call in CALLS and
+wait a fixed latency before answering, like a round trip to AWS would.
+
+The fleet is made of boto's own classes (Instance, Reservation, Tag,
+DBInstance), so hosts/ec2.py handles it as it would real API responses:
+
+ - about 90% of the instances are running, the rest stopped or terminated
+ - about 80% are in a VPC subnet, most of them with a public address, and
+   the rest are EC2-Classic instances with a public DNS name
+ - instances are tagged the way our CloudFormation stacks tag them, and some
+   are not tagged at all
+ - every 50 instances come with an RDS instance, and every 100 with an
+   ElastiCache cluster; some of the instances' addresses have Route53
+   records
+
+Only the subset of the API that hosts/ec2.py uses is implemented.
+
+The other benchmarks use make_fleet() for their instances too, and share
+the helpers below it: load_ec2_inventory() to import hosts/ec2.py,
+get_ec2_inventory() for an Ec2Inventory to build records with, and
+peak_rss().
+'''
+
+import argparse
+import copy
+import fnmatch
+import os
+import random
+import resource
+import threading
+import time
+from collections import defaultdict
+
+from boto import ec2, elasticache, rds, route53
+from boto.ec2.group import Group
+from boto.ec2.instance import Instance, InstancePlacement, InstanceState, Reservation
+from boto.ec2.regioninfo import RegionInfo
+from boto.ec2.tag import Tag
+from boto.rds.dbinstance import DBInstance
+from boto.rds.parametergroup import ParameterGroup
+from boto.resultset import ResultSet
+
+HOSTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'hosts')
+EC2_PY = os.path.join(HOSTS_DIR, 'ec2.py')
+EC2_INI = os.path.join(HOSTS_DIR, 'ec2.ini')
+
+# Number of calls made to each API method, e.g. CALLS['ec2.get_all_tags']
+CALLS = defaultdict(int)
+
+# Instances per region
+FLEETS = {}
+
+_lock = threading.Lock()
+_latency = 0.0
+
+ZONE_NAME = 'firecares.org.'
+
+# Page size of the RDS API
+RDS_PAGE_SIZE = 100
+
+
+def call(name):
+    ''' Counts a call to an API method and waits as long as the round trip
+    would take '''
+
+    with _lock:
+        CALLS[name] += 1
+    if _latency:
+        time.sleep(_latency)
+
+
+def load_ec2_inventory():
+    ''' Imports hosts/ec2.py as a module without running the inventory '''
+
+    try:
+        from importlib.util import module_from_spec, spec_from_file_location
+    except ImportError:
+        # Python 2
+        import imp
+        return imp.load_source('ec2_inventory', EC2_PY)
+
+    spec = spec_from_file_location('ec2_inventory', EC2_PY)
+    module = module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_ec2_inventory():
+    ''' Creates an empty Ec2Inventory with the settings in ec2.ini, without
+    reading the cache or calling AWS '''
+
+    module = load_ec2_inventory()
+    inventory = module.Ec2Inventory.__new__(module.Ec2Inventory)
+    inventory.inventory = inventory._empty_inventory()
+    inventory.index = {}
+    inventory.credentials = {}
+    inventory.args = argparse.Namespace(boto_profile=None, refresh_cache=False)
+    inventory.read_settings()
+    return inventory
+
+
+def peak_rss():
+    ''' Peak RSS of this process in KB. ru_maxrss carries over the RSS of the
+    process that forked us on Linux, so prefer the high water mark of our
+    own address space when /proc is available. '''
+
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def make_fleet(count, region, seed=1):
+    ''' Generates count instances in a region '''
+
+    rnd = random.Random('%s-%s' % (region, seed))
+    fleet = []
+    for i in range(count):
+        instance = Instance()
+        instance.id = 'i-%s%06x' % (region[-1], i)
+        instance.region = RegionInfo(name=region)
+        instance.image_id = 'ami-%04x' % rnd.randint(0, 40)
+        instance.instance_type = rnd.choice(['t2.micro', 't2.medium', 'm4.large', 'c4.xlarge'])
+        instance.key_name = rnd.choice(['firecares-dev', 'firecares-prod', None])
+        instance.launch_time = '20%02d-%02d-%02dT%02d:%02d:%02d.000Z' % (
+            rnd.randint(15, 19), rnd.randint(1, 12), rnd.randint(1, 28),
+            rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))
+        instance._placement = InstancePlacement(region + rnd.choice('abcd'))
+
+        state = rnd.random()
+        if state < 0.9:
+            instance._state = InstanceState(16, 'running')
+        elif state < 0.97:
+            instance._state = InstanceState(80, 'stopped')
+        else:
+            instance._state = InstanceState(48, 'terminated')
+
+        octets = (i // 250 % 250, i % 250)
+        instance.private_ip_address = '10.%d.%d.%d' % ((i // 62500,) + octets)
+        instance.private_dns_name = 'ip-10-%d-%d-%d.ec2.internal' % ((i // 62500,) + octets)
+        addressing = rnd.random()
+        if addressing < 0.8:
+            instance.vpc_id = 'vpc-%04x' % rnd.randint(0, 3)
+            instance.subnet_id = 'subnet-%04x' % rnd.randint(0, 15)
+        if addressing < 0.65 or addressing >= 0.8:
+            instance.ip_address = '54.%d.%d.%d' % ((rnd.randint(0, 255),) + octets)
+            instance.public_dns_name = 'ec2-%s.compute-1.amazonaws.com' % instance.ip_address.replace('.', '-')
+            instance.dns_name = instance.public_dns_name
+
+        group = Group()
+        group.id = 'sg-%04x' % rnd.randint(0, 30)
+        group.name = 'firecares-%d' % rnd.randint(0, 30)
+        instance.groups = [group]
+
+        if rnd.random() < 0.05:
+            instance.tags = {}
+        else:
+            kind = rnd.choice(['web_server', 'celerybeat'])
+            env = rnd.choice(['dev', 'prod'])
+            stack = 'firecares-%s-%06x-%s' % (env, rnd.randint(0, 99), rnd.choice(['web', 'beat']))
+            instance.tags = {'Name': '%s-%s-%06x' % (kind, env, rnd.randint(0, 99)),
+                             'Group': '%s-%s' % (kind, env),
+                             'environment': env,
+                             'aws:cloudformation:stack-name': stack,
+                             'aws:cloudformation:logical-id': 'WebServerGroup'}
+        fleet.append(instance)
+
+    return fleet
+
+
+def _get_filter_value(instance, key):
+    if key == 'instance-state-name':
+        return instance.state
+    elif key == 'instance-id':
+        return instance.id
+    elif key.startswith('tag:'):
+        return instance.tags.get(key[4:])
+    return {
+        'instance-type': instance.instance_type,
+        'ip-address': instance.ip_address,
+        'private-ip-address': instance.private_ip_address,
+        'dns-name': instance.public_dns_name,
+        'private-dns-name': instance.private_dns_name,
+        'vpc-id': instance.vpc_id,
+        'subnet-id': instance.subnet_id,
+    }[key]
+
+
+def _matches(instance, filters):
+    for key, values in filters.items():
+        if not isinstance(values, list):
+            values = [values]
+        value = _get_filter_value(instance, key)
+        if value is None or not any(fnmatch.fnmatchcase(value, pattern) for pattern in values):
+            return False
+    return True
+
+
+class FakeEC2Connection(object):
+
+    def __init__(self, region):
+        self.fleet = FLEETS[region]
+
+    def get_all_instances(self, instance_ids=None, filters=None, **kwargs):
+        call('ec2.get_all_instances')
+        reservations = []
+        for instance in self.fleet:
+            if instance_ids and instance.id not in instance_ids:
+                continue
+            if filters and not _matches(instance, filters):
+                continue
+            # hosts/ec2.py replaces the tags it is given
+            instance = copy.copy(instance)
+            instance.tags = dict(instance.tags)
+            reservation = Reservation()
+            reservation.instances = [instance]
+            reservations.append(reservation)
+        return reservations
+
+    def get_all_tags(self, filters=None, **kwargs):
+        call('ec2.get_all_tags')
+        instance_ids = set(filters['resource-id'])
+        tags = []
+        for instance in self.fleet:
+            if instance.id in instance_ids:
+                for name, value in sorted(instance.tags.items()):
+                    tags.append(Tag(res_id=instance.id, res_type='instance', name=name, value=value))
+        return tags
+
+
+class FakeRDSConnection(object):
+
+    def __init__(self, region):
+        self.dbinstances = []
+        for i in range(max(1, len(FLEETS[region]) // 50)):
+            dbinstance = DBInstance()
+            dbinstance.id = 'firecares-%s-db-%d' % (region, i)
+            dbinstance.status = 'available' if i % 5 else 'backing-up'
+            dbinstance.endpoint = ('%s.abcdefgh.%s.rds.amazonaws.com' % (dbinstance.id, region), 5432)
+            dbinstance.availability_zone = region + 'a'
+            dbinstance.instance_class = 'db.m4.large'
+            dbinstance.engine = 'postgres'
+            parameter_group = ParameterGroup()
+            parameter_group.name = 'default.postgres9.6'
+            dbinstance.parameter_groups = [parameter_group]
+            dbinstance.subnet_group = None
+            dbinstance.tags = {}
+            self.dbinstances.append(dbinstance)
+
+    def get_all_dbinstances(self, marker=None, **kwargs):
+        call('rds.get_all_dbinstances')
+        start = int(marker or 0)
+        page = ResultSet()
+        page.extend(self.dbinstances[start:start + RDS_PAGE_SIZE])
+        if start + RDS_PAGE_SIZE < len(self.dbinstances):
+            page.marker = str(start + RDS_PAGE_SIZE)
+        else:
+            page.marker = None
+        return page
+
+
+class FakeElastiCacheConnection(object):
+
+    def __init__(self, region):
+        self.region = region
+        self.count = max(1, len(FLEETS[region]) // 100)
+
+    def describe_cache_clusters(self, *args, **kwargs):
+        call('elasticache.describe_cache_clusters')
+        clusters = []
+        for i in range(self.count):
+            cluster_id = 'firecares-cache-%d' % i
+            address = '%s.abcdef.cfg.use1.cache.amazonaws.com' % cluster_id
+            clusters.append({
+                'CacheClusterId': cluster_id,
+                'CacheClusterStatus': 'available',
+                'ConfigurationEndpoint': {'Address': address, 'Port': 11211},
+                'CacheNodes': [{'CacheNodeId': '%04d' % node,
+                                'CacheNodeStatus': 'available',
+                                'Endpoint': {'Address': '%s.%04d.%s' % (cluster_id, node, address), 'Port': 11211}}
+                               for node in range(2)],
+                'PreferredAvailabilityZone': self.region + 'b',
+                'CacheNodeType': 'cache.t2.micro',
+                'SecurityGroups': [{'SecurityGroupId': 'sg-cache'}],
+                'Engine': 'memcached',
+                'CacheParameterGroup': {'CacheParameterGroupName': 'default.memcached1.4',
+                                        'CacheNodeIdsToReboot': [],
+                                        'ParameterApplyStatus': 'in-sync'},
+                'ReplicationGroupId': None,
+            })
+        return {'DescribeCacheClustersResponse': {'DescribeCacheClustersResult': {'CacheClusters': clusters}}}
+
+    def describe_replication_groups(self, *args, **kwargs):
+        call('elasticache.describe_replication_groups')
+        return {'DescribeReplicationGroupsResponse': {'DescribeReplicationGroupsResult': {'ReplicationGroups': []}}}
+
+
+class FakeZone(object):
+
+    def __init__(self, zone_id, name, records):
+        self.id = zone_id
+        self.name = name
+        self.records = records
+        self.resourcerecordsetcount = str(len(records))
+
+
+class FakeRecord(object):
+
+    def __init__(self, name, values):
+        self.name = name
+        self.resource_records = values
+
+
+class FakeRoute53Connection(object):
+
+    def __init__(self, *args, **kwargs):
+        records = []
+        for region, fleet in sorted(FLEETS.items()):
+            for instance in fleet[::20]:
+                if instance.ip_address:
+                    name = '%s.%s' % (instance.id, ZONE_NAME)
+                    records.append(FakeRecord(name, [instance.ip_address]))
+        self.zones = [FakeZone('Z%d' % len(records), ZONE_NAME, records)]
+
+    def get_zones(self):
+        call('route53.get_zones')
+        return self.zones
+
+    def get_all_rrsets(self, zone_id, *args, **kwargs):
+        call('route53.get_all_rrsets')
+        for zone in self.zones:
+            if zone.id == zone_id:
+                return list(zone.records)
+        return []
+
+
+def install(count, latency=0.0, regions=('us-east-1',)):
+    ''' Generates a fleet of count instances in each region and makes the
+    boto connections hosts/ec2.py uses answer from it, waiting latency
+    seconds per call '''
+
+    global _latency
+    _latency = latency
+    CALLS.clear()
+    FLEETS.clear()
+    for region in regions:
+        FLEETS[region] = make_fleet(count, region)
+
+    ec2.connect_to_region = lambda region, **kwargs: FakeEC2Connection(region)
+    rds.connect_to_region = lambda region, **kwargs: FakeRDSConnection(region)
+    elasticache.connect_to_region = lambda region, **kwargs: FakeElastiCacheConnection(region)
+    route53.Route53Connection = FakeRoute53Connection
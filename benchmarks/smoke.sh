@@ -0,0 +1,16 @@
+#!/bin/bash
+
+# Runs every inventory benchmark once, on a small fleet and without API
+# latency, to check that hosts/ec2.py and the benchmarks still work, e.g. in
+# CI. Stops with a non-zero status at the first one that fails.
+# PYTHON=python3 ./benchmarks/smoke.sh runs them with another interpreter.
+
+set -e
+cd "$(dirname "$0")"
+
+PYTHON=${PYTHON:-python}
+
+$PYTHON ec2_inventory.py --fleets 100 --latency 0
+$PYTHON ec2_inventory.py --fleets 100 --latency 0 --services
+$PYTHON ec2_groups.py --instances 100 --repeat 1
+$PYTHON ec2_cache.py --hosts 100
@@ -1,3 +1,4 @@
+import bisect
 import click
 import time
 import sh
@@ -5,6 +6,8 @@ import os
 import datetime
 import re
 import sys
+import threading
+from multiprocessing.pool import ThreadPool
 from tabulate import tabulate
 from boto.cloudformation.connection import CloudFormationConnection
 from boto.cloudformation.stack import Stack
@@ -12,7 +15,6 @@ from boto import connect_ec2
 from boto.exception import BotoServerError, EC2ResponseError
 from boto.ec2 import elb
 from boto.ec2.autoscale import AutoScaleConnection
-from boto.ec2.connection import EC2Connection
 from boto.route53 import connect_to_region
 from boto.route53.record import ResourceRecordSets
 from stacks.firecares_db import t as db_server_stack
@@ -24,6 +26,306 @@ DNS = {
     'prod': 'firecares.org'
 }
 
+# The most autoscaling groups a single DescribeAutoScalingGroups call can name
+MAX_GROUP_NAMES = 50
+
+
+class AWSConnections(object):
+    """
+    Registry of the AWS connections the commands use. Each connection is created on first use and reused afterwards,
+    so that credentials are looked up, and HTTPS connections set up, once per command rather than once per function
+    that needs them. boto connections are not safe to share between threads, so every thread gets its own.
+
+    The connections can be replaced, e.g. in tests, by creating the registry with other factories:
+
+        deploy.aws = AWSConnections(cloudformation=lambda: FakeCloudFormationConnection())
+    """
+    default_factories = {
+        'cloudformation': CloudFormationConnection,
+        'ec2': connect_ec2,
+        'autoscale': AutoScaleConnection,
+        'elb': lambda: elb.connect_to_region('us-east-1'),
+        'route53': lambda: connect_to_region('us-east-1'),
+    }
+
+    def __init__(self, **factories):
+        self.factories = dict(self.default_factories, **factories)
+        self.local = threading.local()
+
+    def get(self, service):
+        """
+        Returns this thread's connection to the service (cloudformation, ec2, autoscale, elb or route53).
+        """
+        connections = self.local.__dict__.setdefault('connections', {})
+        if service not in connections:
+            connections[service] = self.factories[service]()
+        return connections[service]
+
+
+aws = AWSConnections()
+
+
+class DescribeCache(object):
+    """
+    Read-through cache of the stacks, autoscaling groups, load balancers and Route53 aliases a command looks up, so
+    that each of them is only described once per command.
+
+    Every stack is listed at most once, paging through describe_stacks, and the stacks are indexed by name so that
+    those whose name starts with a prefix are found without going through all of them. Stacks that are created,
+    updated or deleted must be invalidated, after which they are described again the next time they are looked up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = {}
+        # Position of each stack in the listing, which is kept as the order of the stacks
+        self.positions = {}
+        # Sorted names of the stacks, the index of their prefixes
+        self.names = []
+        self.listed = False
+        self.stale = set()
+        self.groups = {}
+        self.load_balancers = None
+        self.zone = None
+        self.aliases = {}
+
+    def add_stack(self, stack):
+        if stack.stack_name not in self.stacks:
+            bisect.insort(self.names, stack.stack_name)
+            # Stacks that were not listed are new ones, which AWS would list first
+            self.positions[stack.stack_name] = min(self.positions.values() or [0]) - 1
+        self.stacks[stack.stack_name] = stack
+        self.stale.discard(stack.stack_name)
+
+    def remove_stack(self, name):
+        if name in self.stacks:
+            self.names.remove(name)
+            del self.positions[name]
+            del self.stacks[name]
+        self.stale.discard(name)
+
+    def get_stack(self, name):
+        """
+        Returns the stack with the given name, raising BotoServerError if there is none as describe_stacks does.
+        """
+        with self.lock:
+            if name in self.stacks and name not in self.stale:
+                return self.stacks[name]
+
+        try:
+            stack = aws.get('cloudformation').describe_stacks(stack_name_or_id=name)[0]
+        except BotoServerError:
+            with self.lock:
+                self.remove_stack(name)
+            raise
+
+        with self.lock:
+            self.add_stack(stack)
+        return stack
+
+    def find_stack(self, name):
+        """
+        Returns the stack with the given name, or None if it cannot be described. Once every stack has been listed,
+        a stack that is not in the listing, and was not invalidated since, is known not to exist without asking.
+        """
+        with self.lock:
+            if self.listed and name not in self.stacks and name not in self.stale:
+                return None
+
+        try:
+            return self.get_stack(name)
+        except BotoServerError:
+            return None
+
+    def get_stacks(self, prefix=''):
+        """
+        Returns every stack whose name starts with prefix, in the order describe_stacks lists them.
+        """
+        with self.lock:
+            listed = self.listed
+
+        if not listed:
+            stacks = describe_all_stacks(aws.get('cloudformation'))
+            with self.lock:
+                self.stacks = dict((x.stack_name, x) for x in stacks)
+                self.positions = dict((x.stack_name, position) for position, x in enumerate(stacks))
+                self.names = sorted(self.stacks)
+                self.stale.clear()
+                self.listed = True
+
+        with self.lock:
+            stale = [name for name in self.stale if name.startswith(prefix)]
+        for name in stale:
+            try:
+                self.get_stack(name)
+            except BotoServerError:
+                pass
+
+        with self.lock:
+            names = []
+            for name in self.names[bisect.bisect_left(self.names, prefix):]:
+                if not name.startswith(prefix):
+                    break
+                names.append(name)
+            return [self.stacks[name] for name in sorted(names, key=self.positions.get)]
+
+    def invalidate_stack(self, name):
+        """
+        Marks the stack as changed (or created, or deleted) so that it is described again.
+        """
+        with self.lock:
+            self.stale.add(name)
+
+    def get_groups(self, names):
+        """
+        Returns the autoscaling groups with the given names, by name. The groups that were not described yet are
+        described in as few calls as AWS allows, i.e. one per 50 groups.
+        """
+        with self.lock:
+            missing = sorted(set(names) - set(self.groups))
+
+        for i in range(0, len(missing), MAX_GROUP_NAMES):
+            next_token = None
+            while True:
+                page = aws.get('autoscale').get_all_groups(missing[i:i + MAX_GROUP_NAMES], next_token=next_token)
+                with self.lock:
+                    self.groups.update((g.name, g) for g in page)
+                next_token = page.next_token
+                if not next_token:
+                    break
+
+        with self.lock:
+            return dict((name, self.groups[name]) for name in names if name in self.groups)
+
+    def get_load_balancers(self):
+        with self.lock:
+            if self.load_balancers is None:
+                self.load_balancers = aws.get('elb').get_all_load_balancers()
+            return self.load_balancers
+
+    def get_zone(self):
+        """
+        Returns the firecares.org hosted zone.
+        """
+        with self.lock:
+            if self.zone is None:
+                self.zone = aws.get('route53').get_zone('firecares.org')
+            return self.zone
+
+    def get_alias(self, dns):
+        """
+        Returns the DNS name the A record of dns is an alias of.
+        """
+        zone = self.get_zone()
+        with self.lock:
+            if dns not in self.aliases:
+                self.aliases[dns] = zone.get_a(dns).alias_dns_name
+            return self.aliases[dns]
+
+    def invalidate_alias(self, dns):
+        with self.lock:
+            self.aliases.pop(dns, None)
+
+
+cache = DescribeCache()
+
+# Security groups (and ports) of the services the web servers are given access to
+WEB_ACCESS = [('sg-13fd9e77', 5432, 'NFIRS'), ('sg-f1ce248e', 5043, 'ELK'), ('sg-8163f8e6', 11211, 'memcached')]
+
+# Stack statuses that start an operation on the stack; failures of that operation come after them
+OPERATION_STARTS = ['CREATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'DELETE_IN_PROGRESS']
+
+# Alias of the load balancer of a web stack, whose name holds the root of the stack's name
+WEB_STACK_ALIAS = re.compile('dualstack\.fc-(prod|dev)-(.*)-\d+\.us-east-1\.elb\.amazonaws\.com\.')
+
+
+def map_concurrently(func, items, workers=8):
+    """
+    Calls func on every item on a pool of threads and returns the results in the order of the items.
+    """
+    if len(items) <= 1:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_new_stack_events(conn, stack_id, last_event_id=None):
+    """
+    Returns the events of the stack that came after the event last_event_id (all of them if it is None), oldest first.
+
+    Events are listed newest first, so pages are only fetched until last_event_id is reached: a poll of a stack
+    that is in progress usually takes a single call.
+    """
+    events = []
+    next_token = None
+    while True:
+        page = conn.describe_stack_events(stack_id, next_token)
+        for event in page:
+            if event.event_id == last_event_id:
+                return events[::-1]
+            events.append(event)
+        next_token = page.next_token
+        if not next_token:
+            return events[::-1]
+
+
+def get_last_stack_event_id(conn, stack_id):
+    """
+    Returns the id of the most recent event of the stack, to wait on an operation that is about to start from.
+    """
+    events = conn.describe_stack_events(stack_id)
+    return events[0].event_id if events else None
+
+
+def wait_for_stack(conn, stack_id, last_event_id=None, min_delay=2, max_delay=10):
+    """
+    Waits for the operation in progress on the stack to finish, echoing the events of its resources as they come,
+    and returns the status it finished with.
+
+    Only the events after last_event_id are considered. Polls are made every min_delay seconds while events keep
+    coming, and backed off up to every max_delay seconds while they don't. The first failed event of any resource
+    ends the wait straight away, with that event's status, as does the stack rolling back.
+    """
+    delay = min_delay
+    while True:
+        events = get_new_stack_events(conn, stack_id, last_event_id)
+        for event in events:
+            failed = event.resource_status.endswith('FAILED')
+            click.secho('{} {:<40} {:<32} {}'.format(event.timestamp.strftime('%H:%M:%S'), event.logical_resource_id,
+                                                     event.resource_status, event.resource_status_reason or ''),
+                        fg='red' if failed else 'green' if event.resource_status.endswith('COMPLETE') else None)
+
+            if failed:
+                return event.resource_status
+            if event.resource_type == 'AWS::CloudFormation::Stack' and event.physical_resource_id == stack_id and \
+                    ('ROLLBACK' in event.resource_status or not event.resource_status.endswith('IN_PROGRESS')):
+                return event.resource_status
+
+        if events:
+            last_event_id = events[-1].event_id
+            delay = min_delay
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def describe_all_stacks(conn):
+    """
+    Returns every stack that is not deleted, from all of the pages of describe_stacks.
+    """
+    stacks = []
+    next_token = None
+    while True:
+        page = conn.describe_stacks(next_token=next_token)
+        stacks.extend(page)
+        next_token = page.next_token
+        if not next_token:
+            return stacks
+
 
 def get_web_security_group(stack):
     """
@@ -34,48 +336,107 @@ def get_web_security_group(stack):
             return output
 
 
-def delete_firecares_stack(stack_or_name):
+def delete_firecares_stack(stack_or_name, wait=False, echo=click.echo):
     """
     Deletes the stack and un-registers entries in various security groups the app needs access to.
+
+    With wait, waits for the stack to be deleted and returns the status the deletion finished with. Progress is
+    reported through echo.
     """
-    ec2 = connect_ec2()
-    conn = CloudFormationConnection()
+    ec2 = aws.get('ec2')
+    conn = aws.get('cloudformation')
 
     if not isinstance(stack_or_name, Stack):
-        stack_or_name = conn.describe_stacks(stack_name_or_id=stack_or_name)[0]
+        stack_or_name = cache.get_stack(stack_or_name)
 
     ws = get_web_security_group(stack_or_name)
     if ws:
         old_sg = ws.value
-        click.echo('Revoking access from security group {} to NFIRS.'.format(old_sg))
-        ec2.revoke_security_group(group_id='sg-13fd9e77', src_security_group_group_id=old_sg, ip_protocol='tcp',
-                                  from_port=5432, to_port=5432)
+        for group_id, port, service in WEB_ACCESS:
+            echo('Revoking access from security group {} to {}.'.format(old_sg, service))
+            try:
+                ec2.revoke_security_group(group_id=group_id, src_security_group_group_id=old_sg, ip_protocol='tcp',
+                                          from_port=port, to_port=port)
+            except EC2ResponseError as e:
+                # Revoked by an earlier attempt at deleting the stack
+                if e.error_code != 'InvalidPermission.NotFound':
+                    raise
+                echo('Access from security group {} to {} already revoked.'.format(old_sg, service))
+
+    echo('Deleting stack: {}'.format(stack_or_name.stack_name))
+    if wait:
+        last_event_id = get_last_stack_event_id(conn, stack_or_name.stack_id)
+    conn.delete_stack(stack_or_name.stack_name)
+    cache.invalidate_stack(stack_or_name.stack_name)
 
-        click.echo('Revoking access from security group {} to ELK.'.format(old_sg))
-        ec2.revoke_security_group(group_id='sg-f1ce248e', src_security_group_group_id=old_sg, ip_protocol='tcp',
-                                  from_port=5043, to_port=5043)
+    if wait:
+        # Once deleted, the stack's events can only be described by its id
+        status = wait_for_stack(conn, stack_or_name.stack_id, last_event_id)
+        click.secho('Stack {} deletion finished: {}'.format(stack_or_name.stack_name, status))
+        return status
 
-        click.echo('Revoking access from security group {} to memcached'.format(old_sg))
-        ec2.revoke_security_group(group_id='sg-8163f8e6', src_security_group_group_id=old_sg, ip_protocol='tcp',
-                                  from_port=11211, to_port=11211)
 
-    click.echo('Deleting stack: {}'.format(stack_or_name.stack_name))
-    conn.delete_stack(stack_or_name.stack_name)
+def delete_firecares_stacks(stacks, wait=False, min_delay=5, max_delay=30, timeout=1800):
+    """
+    Deletes the stacks, each as delete_firecares_stack does, and returns the status of each one by stack name.
 
+    The stacks are deleted concurrently. With wait, the deletions are then waited on together, by listing the stacks
+    every min_delay seconds, backing off up to every max_delay seconds, until each of them is deleted (no longer
+    listed) or has failed to be (DELETE_FAILED). Stacks that are still being deleted after timeout seconds are left
+    with the status they were last listed with.
 
-def _delete_old_stacks(ami=None, keep=2, env='dev'):
-    conn = CloudFormationConnection()
+    Only the calling thread echoes: the progress of each deletion is echoed once all of them have started, a stack
+    at a time, followed by the changes of status the polls see.
+    """
+    def delete(stack):
+        lines = []
+        try:
+            delete_firecares_stack(stack, echo=lines.append)
+        except BotoServerError as e:
+            return 'ERROR: {}'.format(e.error_message or e.reason), lines
+        return 'DELETE_IN_PROGRESS', lines
+
+    statuses = {}
+    for stack, (status, lines) in zip(stacks, map_concurrently(delete, stacks)):
+        for line in lines:
+            click.echo(line)
+        statuses[stack.stack_name] = status
+    pending = [x for x in stacks if statuses[x.stack_name] == 'DELETE_IN_PROGRESS'] if wait else []
+
+    conn = aws.get('cloudformation')
+    deadline = time.time() + timeout
+    delay = min_delay
+    while pending and time.time() < deadline:
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+        current = dict((x.stack_id, x.stack_status) for x in describe_all_stacks(conn))
+        for stack in pending:
+            status = current.get(stack.stack_id, 'DELETE_COMPLETE')
+            if status != statuses[stack.stack_name]:
+                click.echo('Stack {}: {}'.format(stack.stack_name, status))
+            statuses[stack.stack_name] = status
+        pending = [x for x in pending if statuses[x.stack_name] not in ('DELETE_COMPLETE', 'DELETE_FAILED')]
+
+    return statuses
+
+
+def _delete_old_stacks(ami=None, keep=2, env='dev', wait=False):
+    """
+    Deletes the old web stacks of the environment and reports the outcome for each one. Returns whether all of them
+    were deleted, or are being deleted when not waiting on them.
+    """
     # If there are old stacks, flag them for deletion
     name = 'firecares-{}-web'.format(env)
-    old_stacks = [n for n in conn.describe_stacks() if name in n.stack_name and (not ami or ami not in n.stack_name)]
+    old_stacks = [n for n in cache.get_stacks(name) if not ami or ami not in n.stack_name]
 
     # Keep 2 stacks by default so that we don't have any potential downtime
     old_stacks = sorted(old_stacks, key=lambda x: x.creation_time, reverse=True)[keep:]
     click.secho("Deleting {count} stacks...".format(count=len(old_stacks)))
-    for old_stack in old_stacks:
-        click.secho("Deleting {}".format(old_stack.stack_name))
-        delete_firecares_stack(old_stack)
+    statuses = delete_firecares_stacks(old_stacks, wait=wait)
+    if statuses:
+        click.secho(tabulate([[x.stack_name, statuses[x.stack_name]] for x in old_stacks], headers=['NAME', 'STATUS']))
     click.secho("Done")
+    return all(status in ('DELETE_IN_PROGRESS', 'DELETE_COMPLETE') for status in statuses.values())
 
 
 def _get_commit_hash(location='../firecares'):
@@ -120,11 +481,13 @@ def full_deploy(env):
 @click.option('--ami', help='Currently deployed AMI')
 @click.option('--keep', default=2, help='# of stacks to keep in AWS')
 @click.option('--env', default='dev', help='Environment (dev/prod)')
-def delete_old_stacks(ami, keep, env):
+@click.option('--wait', default=False, is_flag=True, help='Wait for the stacks to be deleted')
+def delete_old_stacks(ami, keep, env, wait):
     """
     Delete old FireCARES webserver CloudFormation stacks from AWS.
     """
-    _delete_old_stacks(ami, keep, env)
+    if not _delete_old_stacks(ami, keep, env, wait):
+        click.get_current_context().exit(code=1)
 
 
 @firecares_deploy.command()
@@ -159,10 +522,9 @@ def switch_dns(env, hash):
 
     dns = DNS[env]
 
-    elb_conn = elb.connect_to_region('us-east-1')
-    r_conn = connect_to_region('us-east-1')
+    r_conn = aws.get('route53')
 
-    lbs = elb_conn.get_all_load_balancers()
+    lbs = cache.get_load_balancers()
     fclbs = sorted(filter(lambda x: x.name.startwith('fc-{}'.format(env)), lbs), key=lambda x: x.name)
     if not fblbs:
         print 'No load balancer for env: {}'.format(env)
@@ -171,7 +533,7 @@ def switch_dns(env, hash):
         print 'WARNING: Only 1 load balancer in place, potential for no effect on DNS switch'
     target = fclbs[0]
 
-    zone = r_conn.get_zone('firecares.org')
+    zone = cache.get_zone()
     record = zone.find_records(dns, 'A')
     hosted_zone = record.alias_hosted_zone_id
 
@@ -187,6 +549,7 @@ def switch_dns(env, hash):
     cr.add_value(dest)
 
     rrs.commit()
+    cache.invalidate_alias(dns)
 
     print 'Set {dns} ALIAS to {alias}'.format(dns=dns, alias=dest)
 
@@ -209,49 +572,44 @@ def deploy(ami, beatami, env, commithash, dbpass, dbuser, s3cors, keep):
 
     if keep < 2:
         keep = 1
-    conn = CloudFormationConnection()
-    ec2 = connect_ec2()
+    conn = aws.get('cloudformation')
+    ec2 = aws.get('ec2')
 
     db_stack = '-'.join(['firecares', env])
     key_name = '-'.join(['firecares', env])
 
     name = 'firecares-{env}-web-{commithash}'.format(env=env, commithash=commithash)
 
-    try:
-        stack = conn.describe_stacks(stack_name_or_id=name)[0]
+    # Every stack deploy looks up (its own, the db stack and the old ones it deletes) is found in one listing
+    cache.get_stacks('firecares-')
+
+    stack = cache.find_stack(name)
+    if stack:
+        stack_id = stack.stack_id
 
     # The stack has not been created.
-    except BotoServerError:
-        conn.create_stack(stack_name=name,
-                          template_body=web_server_stack.to_json(),
-                          parameters=[
-                              ('KeyName', key_name),
-                              ('baseAmi', ami),
-                              ('Environment', env),
-                              ('CommitHash', commithash),
-                              ('beatAmi', beatami)])
-
-        stack = conn.describe_stacks(stack_name_or_id=name)[0]
-
-    while stack.stack_status == 'CREATE_IN_PROGRESS':
+    else:
+        stack_id = conn.create_stack(stack_name=name,
+                                     template_body=web_server_stack.to_json(),
+                                     parameters=[
+                                         ('KeyName', key_name),
+                                         ('baseAmi', ami),
+                                         ('Environment', env),
+                                         ('CommitHash', commithash),
+                                         ('beatAmi', beatami)])
+        cache.invalidate_stack(name)
+
+    if not stack or stack.stack_status == 'CREATE_IN_PROGRESS':
         click.secho('Stack creation in progress, waiting until the stack is available.')
-        time.sleep(10)
-        stack = conn.describe_stacks(stack_name_or_id=name)[0]
+        if wait_for_stack(conn, stack_id) == 'CREATE_COMPLETE':
+            cache.invalidate_stack(name)
+            stack = cache.get_stack(name)
 
-    if stack.stack_status != 'CREATE_COMPLETE':
+    if not stack or stack.stack_status != 'CREATE_COMPLETE':
         click.secho('Web stack creation failed...bailing')
         click.get_current_context().exit(code=1)
 
-    db_stack = conn.describe_stacks(stack_name_or_id=db_stack)[0]
-
-    # minor debugging
-    # print "CURRENT STACK STATUS"
-    # print db_stack.stack_status
-    # print db_stack
-
-    # if db_stack.stack_status != 'UPDATE_COMPLETE':
-    #    click.secho('DB stack update failed...bailing')
-    #    click.get_current_context().exit(code=2)
+    db_stack = cache.get_stack(db_stack)
 
     sg = get_web_security_group(stack)
 
@@ -269,65 +627,150 @@ def deploy(ami, beatami, env, commithash, dbpass, dbuser, s3cors, keep):
             db_params.extend([('DBUser', dbuser, True), ('DBPassword', dbpass, True)])
             deploy_stack = db_server_stack
 
+        last_event_id = get_last_stack_event_id(conn, db_stack.stack_id)
         try:
             conn.update_stack(db_stack.stack_name,
                               template_body=deploy_stack.to_json(),
                               parameters=db_params)
         except BotoServerError:
             click.secho('Stack already updated.')
-
-        click.secho('Updating NFIRS database security group with ingress from new web security group.')
-        try:
-            ec2.authorize_security_group(group_id='sg-13fd9e77', src_security_group_group_id=sg.value, ip_protocol='tcp',
-                                         from_port=5432, to_port=5432)
-        except EC2ResponseError:
-            click.secho('NFIRS web security group already exists.')
-
-        click.secho('Updating ELK security group with ingress from new web security group.')
-        try:
-            ec2.authorize_security_group(group_id='sg-f1ce248e', src_security_group_group_id=sg.value, ip_protocol='tcp',
-                                         from_port=5043, to_port=5043)
-        except EC2ResponseError:
-            click.secho('ELK web security group already exists.')
-
-        click.secho('Updating memcached security group with ingress from new web security group.')
-        try:
-            ec2.authorize_security_group(group_id='sg-8163f8e6', src_security_group_group_id=sg.value, ip_protocol='tcp',
-                                         from_port=11211, to_port=11211)
-        except EC2ResponseError:
-            click.secho('memcached web security group already exists.')
-
-    _delete_old_stacks(ami=ami, env=env, keep=keep)
+        else:
+            cache.invalidate_stack(db_stack.stack_name)
+            click.secho('DB stack update in progress, waiting until it is complete.')
+            if wait_for_stack(conn, db_stack.stack_id, last_event_id) != 'UPDATE_COMPLETE':
+                click.secho('DB stack update failed...bailing')
+                click.get_current_context().exit(code=2)
+
+        for group_id, port, service in WEB_ACCESS:
+            click.secho('Updating {} security group with ingress from new web security group.'.format(service))
+            try:
+                ec2.authorize_security_group(group_id=group_id, src_security_group_group_id=sg.value, ip_protocol='tcp',
+                                             from_port=port, to_port=port)
+            except EC2ResponseError:
+                click.secho('{} web security group already exists.'.format(service))
+
+    if not _delete_old_stacks(ami=ami, env=env, keep=keep):
+        click.secho('Deleting old stacks failed')
+        click.get_current_context().exit(code=3)
 
 
 @firecares_deploy.command()
 @click.option('--name', prompt='Enter the stack name.', confirmation_prompt=True)
-def delete_stack(name):
+@click.option('--wait', default=False, is_flag=True, help='Wait for the stack to be deleted')
+def delete_stack(name, wait):
     """
     Deletes stack and un-register entries in various security groups the app needs access to.
     """
-    delete_firecares_stack(name)
+    if delete_firecares_stack(name, wait=wait) not in (None, 'DELETE_COMPLETE'):
+        click.get_current_context().exit(code=1)
 
 
 def get_web_stacks(env, deployed=True):
-    conn = CloudFormationConnection()
-    r_conn = connect_to_region('us-east-1')
-    zone = r_conn.get_zone('firecares.org')
-
     if env == 'dev':
-        dns = get_dns_root(zone.get_a('test.firecares.org').alias_dns_name)
+        dns = get_dns_root(cache.get_alias('test.firecares.org'))
     elif env == 'prod':
-        dns = get_dns_root(zone.get_a('firecares.org').alias_dns_name)
+        dns = get_dns_root(cache.get_alias('firecares.org'))
 
     to_prune = 'firecares-{env}-web-'.format(env=env)
     if deployed:
-        return [x for x in conn.describe_stacks() if x.stack_name.startswith(to_prune) and dns in x.stack_name]
+        return [x for x in cache.get_stacks(to_prune) if dns in x.stack_name]
     else:
-        return [x for x in conn.describe_stacks() if x.stack_name.startswith(to_prune) and dns not in x.stack_name]
+        return [x for x in cache.get_stacks(to_prune) if dns not in x.stack_name]
+
+
+def get_stack_resources(stacks, logical_ids):
+    """
+    Returns the physical ids of the given logical resources of each stack, as {logical id: physical id} by stack name.
+    The stacks are described concurrently, in one call each.
+    """
+    def describe(stack):
+        conn = aws.get('cloudformation')
+        return dict((r.logical_resource_id, r.physical_resource_id)
+                    for r in conn.describe_stack_resources(stack.stack_id) if r.logical_resource_id in logical_ids)
+
+    return dict(zip([x.stack_name for x in stacks], map_concurrently(describe, stacks)))
+
+
+def get_instances(instance_ids):
+    """
+    Returns the instances with the given ids, by id, described in one call. AWS fails the whole call if any of the
+    instances is gone (e.g. terminated by its group since the group was described), so it is made again without the
+    ones it names, which are left out.
+    """
+    instance_ids = set(instance_ids)
+    while instance_ids:
+        try:
+            reservations = aws.get('ec2').get_all_instances(instance_ids=sorted(instance_ids))
+        except EC2ResponseError as e:
+            gone = instance_ids.intersection(re.findall(r'i-[0-9a-f]+', e.body or ''))
+            if e.error_code != 'InvalidInstanceID.NotFound' or not gone:
+                raise
+            instance_ids -= gone
+        else:
+            return dict((i.id, i) for r in reservations for i in r.instances)
+    return {}
+
+
+def get_stack_machines(stacks, web=True, beat=True):
+    """
+    Returns the web instances (of the WebserverAutoScale group) and the beat instance (BeatInstance) of each stack, as
+    {'web': [instances], 'beat': instance or None} by stack name.
+
+    The ids of the groups and instances of every stack are collected first, so that the groups and the instances are
+    described in a call or so each (see DescribeCache.get_groups and get_instances), however many stacks there are.
+    """
+    logical_ids = (['WebserverAutoScale'] if web else []) + (['BeatInstance'] if beat else [])
+    resources = get_stack_resources(stacks, logical_ids)
+
+    groups = cache.get_groups([x['WebserverAutoScale'] for x in resources.values() if 'WebserverAutoScale' in x])
+
+    inst_ids = set(i.instance_id for g in groups.values() for i in g.instances)
+    inst_ids.update(x['BeatInstance'] for x in resources.values() if 'BeatInstance' in x)
+    instances = get_instances(inst_ids)
+
+    machines = {}
+    for stack in stacks:
+        group = groups.get(resources[stack.stack_name].get('WebserverAutoScale'))
+        machines[stack.stack_name] = {
+            'web': [instances[i.instance_id] for i in group.instances if i.instance_id in instances] if group else [],
+            'beat': instances.get(resources[stack.stack_name].get('BeatInstance'))
+        }
+    return machines
 
 
 def get_dns_root(s):
-    return re.match('dualstack\.fc-(prod|dev)-(.*)-\d+\.us-east-1\.elb\.amazonaws\.com\.', s).groups()[1]
+    return WEB_STACK_ALIAS.match(s).groups()[1]
+
+
+def is_failed_stack(stack):
+    """
+    Whether the last operation on the stack failed or was rolled back.
+    """
+    return 'FAILED' in stack.stack_status or 'ROLLBACK' in stack.stack_status
+
+
+def get_recent_failures(stack, max_pages=5):
+    """
+    Returns the reasons of the failed events of the last operation on the stack, most recent first.
+
+    Events come newest first, so they are paged through only until the event that started the operation, and for
+    max_pages pages at most.
+    """
+    conn = aws.get('cloudformation')
+    reasons = []
+    next_token = None
+    for _ in range(max_pages):
+        events = conn.describe_stack_events(stack.stack_id, next_token)
+        for event in events:
+            if (event.resource_status.endswith('FAILED') and event.resource_status_reason and
+                    event.resource_status_reason not in reasons):
+                reasons.append(event.resource_status_reason)
+            if event.logical_resource_id == stack.stack_name and event.resource_status in OPERATION_STARTS:
+                return reasons
+        next_token = events.next_token
+        if not next_token:
+            break
+    return reasons
 
 
 @firecares_deploy.command()
@@ -337,35 +780,26 @@ def get_dns_root(s):
 @click.option('--showprivate', default=False, is_flag=True)
 @click.option('--onlyold', default=False, is_flag=True)
 def list_machines(env, onlyweb, onlybeat, showprivate, onlyold):
-    econn = EC2Connection()
-    agconn = AutoScaleConnection()
-    cfconn = CloudFormationConnection()
     stacks = get_web_stacks(env, deployed=not onlyold)
 
     if not stacks:
         sys.exit(1)
 
     verbose = not onlyweb and not onlybeat
+    machines = get_stack_machines(stacks, web=onlyweb or verbose, beat=onlybeat or verbose)
 
     for stack in stacks:
         if onlyweb or verbose:
-            asg_id = stack.describe_resources('WebserverAutoScale')[0].physical_resource_id
-            # Get web instances in the autoscaling group
-            asg = agconn.get_all_groups([asg_id])[0]
-            inst_ids = [i.instance_id for i in asg.instances]
-            reservations = econn.get_all_instances(instance_ids=inst_ids)
-            instances = [i.ip_address for r in reservations for i in r.instances]
-            priv_instances = [i.private_ip_address for r in reservations for i in r.instances]
-            click.secho('{}{}'.format('web: ' if verbose else '', ','.join(instances)))
+            # Web instances in the autoscaling group
+            web = machines[stack.stack_name]['web']
+            click.secho('{}{}'.format('web: ' if verbose else '', ','.join(i.ip_address for i in web)))
             if showprivate:
-                click.secho('{}{}'.format('web (private): ' if verbose else '', ','.join(priv_instances)))
+                click.secho('{}{}'.format('web (private): ' if verbose else '', ','.join(i.private_ip_address for i in web)))
 
-        # Get beat instance in stack
+        # Beat instance in stack
         if onlybeat or verbose:
-            beat = stack.describe_resources('BeatInstance')
-            if beat:
-                beat_id = beat[0].physical_resource_id
-                beatinst = econn.get_all_instances(instance_ids=[beat_id])[0].instances[0]
+            beatinst = machines[stack.stack_name]['beat']
+            if beatinst:
                 click.secho('{}{}'.format('beat: ' if verbose else '', beatinst.ip_address))
                 if showprivate:
                     click.secho('{}{}'.format('beat (private): ' if verbose else '', beatinst.private_ip_address))
@@ -376,26 +810,29 @@ def list_stacks():
     """
     Display FireCARES CloudFormation stacks.
     """
-    conn = CloudFormationConnection()
-    econn = EC2Connection()
-    r_conn = connect_to_region('us-east-1')
-    zone = r_conn.get_zone('firecares.org')
-
-    test = zone.get_a('test.firecares.org').alias_dns_name
-    prod = zone.get_a('firecares.org').alias_dns_name
-
-    def get_failures(stack):
-        return ' | '.join(set([x.resource_status_reason for x in stack.describe_events()[:10] if x.resource_status.endswith('FAILED')]))
+    # Where each environment's web stacks are deployed. The root of the name of the stack that is live there is only
+    # looked up once a stack of that environment is listed, and is None if the DNS name is not an alias of a web
+    # stack's load balancer.
+    environments = [('firecares-dev-web-', 'test.firecares.org'), ('firecares-prod-web-', 'firecares.org')]
+    live_roots = {}
 
     def get_deployed(stack):
-        if 'dev-web' in stack.stack_name:
-            if get_dns_root(test) == stack.stack_name.strip('firecares-dev-web-'):
-                return 'test.firecares.org'
-        elif 'prod-web' in stack.stack_name:
-            if get_dns_root(prod) == stack.stack_name.strip('firecares-prod-web-'):
-                return 'firecares.org'
-
-    rows = [[x.stack_name, x.stack_status, x.creation_time.isoformat(), get_deployed(x), get_failures(x)] for x in conn.describe_stacks() if x.stack_name.startswith('firecares')]
+        for prefix, dns in environments:
+            if stack.stack_name.startswith(prefix):
+                if dns not in live_roots:
+                    match = WEB_STACK_ALIAS.match(cache.get_alias(dns))
+                    live_roots[dns] = match.groups()[1] if match else None
+                if live_roots[dns] and live_roots[dns] in stack.stack_name:
+                    return dns
+
+    stacks = cache.get_stacks('firecares')
+
+    # Only stacks whose last operation failed have failures worth reporting
+    failed = [x for x in stacks if is_failed_stack(x)]
+    failures = dict(zip([x.stack_name for x in failed], map_concurrently(get_recent_failures, failed)))
+
+    rows = [[x.stack_name, x.stack_status, x.creation_time.isoformat(), get_deployed(x),
+             ' | '.join(failures.get(x.stack_name, []))] for x in stacks]
     click.secho(tabulate(rows, headers=['NAME', 'STATUS', 'CREATED AT', 'LIVE @', 'ERRORS']))
 
 
@@ -20,6 +20,12 @@ STEPS=8
 EXISTING=0
 KEEP=${KEEP:-2}
 
+# Ansible reads the facts about the EC2 instances that hosts/ec2.py writes
+# (fact_cache_path in hosts/ec2.ini) rather than gathering them all over SSH
+export ANSIBLE_CACHE_PLUGIN=jsonfile
+export ANSIBLE_CACHE_PLUGIN_CONNECTION=${EC2_FACT_CACHE_PATH:-$HOME/.ansible/tmp/ansible-ec2-facts}
+export ANSIBLE_CACHE_PLUGIN_TIMEOUT=86400
+
 if [ "$DBUSER" != "" ]; then
   echo "Using user: ${DBUSER} for database"
 else
@@ -161,6 +167,24 @@ deploy() {
     python deploy.py deploy --env $DEPLOY_ENV --s3cors $URL --ami $AMI --beatami $BEATAMI --commithash $HASH --keep $KEEP
   fi
 
+  # The web autoscaling group has no creation policy, so its instances can
+  # still be launching when the stack completes; wait for them before taking
+  # the inventory snapshot that the rest of the deploy reuses
+  WEB_ASG=$(aws cloudformation describe-stack-resource --stack-name firecares-${DEPLOY_ENV}-web-${HASH} --logical-resource-id WebserverAutoScale --query StackResourceDetail.PhysicalResourceId --output text)
+  echo "Waiting for the instances of $WEB_ASG to be in service..."
+  for i in $(seq 1 60); do
+    IN_SERVICE=$(aws autoscaling describe-auto-scaling-groups --auto-scaling-group-names $WEB_ASG --query "AutoScalingGroups[0].[DesiredCapacity, length(Instances[?LifecycleState=='InService'])]" --output text)
+    if [ "$(echo $IN_SERVICE | cut -d' ' -f 2)" -ge "$(echo $IN_SERVICE | cut -d' ' -f 1)" ]; then
+      break
+    fi
+    sleep 10
+  done
+
+  # Refresh the EC2 inventory once now that the new stack is up, and let the
+  # rest of the deploy (and the playbooks it runs) reuse that cache
+  python hosts/ec2.py --refresh-cache > /dev/null
+  export EC2_CACHE_MAX_AGE=${EC2_CACHE_MAX_AGE:-3600}
+
   stop
   saveTime $STOP 4
 }
@@ -174,8 +198,8 @@ maintOn() {
   echo "Current web tags: $CURRENT_TAG"
 
   # Make sure that the new servers aren't included in the set to show the maintenance mode on
-  MAINT_HOSTS=$(python hosts/ec2.py | python to_inventory.py tag_Group_web_server_${DEPLOY_ENV} $CURRENT_TAG)
-  PRIMARY_HOST=$(python hosts/ec2.py | python to_inventory.py $CURRENT_TAG | sed -e "s/,.*//g"),
+  MAINT_HOSTS=$(python hosts/ec2.py --query "tag_Group_web_server_${DEPLOY_ENV}:!${CURRENT_TAG}")
+  PRIMARY_HOST=$(python hosts/ec2.py --query $CURRENT_TAG | sed -e "s/,.*//g"),
   
   if [ "$KEEP" == "1" ]; then
     echo "Only 1 stack, no need for maintenance mode on old stack..."
@@ -203,9 +227,16 @@ migrateCollectStatic() {
   stepavg 6
   start
 
-  # Now, collectstatic, etc on the first current server
-  NEW_HOSTS=$(python hosts/ec2.py | python to_inventory.py $CURRENT_TAG)
+  # Now, collectstatic, etc on the first current server; refresh the cached
+  # inventory first in case the new web servers were not up when it was taken
+  python hosts/ec2.py --refresh-cache > /dev/null
+  NEW_HOSTS=$(python hosts/ec2.py --query $CURRENT_TAG)
   echo -e "New web IP addresses: ${BOLD}$NEW_HOSTS${BOLDOFF}"
+  if [ "$NEW_HOSTS" == "" ]; then
+    echo "No hosts found for $CURRENT_TAG, aborting..."
+    exit 1
+  fi
+  PRIMARY_HOST=$(echo $NEW_HOSTS | sed -e "s/,.*//g"),
   FIRST_NEW_HOST=$(echo $NEW_HOSTS | cut -d, -f 1)
   echo "Host to run collectstatic/migrations on: $FIRST_NEW_HOST"
   echo "Waiting for SSH to open..."
@@ -290,7 +321,7 @@ turnOffOld() {
   stepavg 8
   start
 
-  ALL_HOSTS=$(python hosts/ec2.py | jq "to_entries[] | select(.key | test(\"tag_Name_(celerybeat|web_server)_${DEPLOY_ENV}\")).value | join(\",\")" | paste -sd "," - | tr -d '\"')
+  ALL_HOSTS=$(python hosts/ec2.py --query "~tag_Name_(celerybeat|web_server)_${DEPLOY_ENV}")
   echo $ALL_HOSTS
 
   CURRENT_TAG="tag_Name_web_server_${DEPLOY_ENV}_$(echo $HASH | tr - _)"
@@ -298,7 +329,7 @@ turnOffOld() {
   echo "Current web tags: $CURRENT_TAG"
 
   # Make sure that the new servers aren't included in the set to show the maintenance mode on
-  MAINT_HOSTS=$(python hosts/ec2.py | python to_inventory.py tag_Group_web_server_${DEPLOY_ENV} $CURRENT_TAG)
+  MAINT_HOSTS=$(python hosts/ec2.py --query "tag_Group_web_server_${DEPLOY_ENV}:!${CURRENT_TAG}")
   
   if [ "$KEEP" == "1" ]; then
     echo "Only 1 stack, no need to turn off maintenance mode...old stack will be destroyed"
@@ -318,7 +349,7 @@ turnOffOld() {
   fi
 
   if [ "$BEAT_MAINT_HOSTS" != "" ]; then
-    BEAT_MAINT_HOSTS=$(python hosts/ec2.py | python to_inventory.py tag_Group_celerybeat_${DEPLOY_ENV} $CURRENT_BEAT_TAG)
+    BEAT_MAINT_HOSTS=$(python hosts/ec2.py --query "tag_Group_celerybeat_${DEPLOY_ENV}:!${CURRENT_BEAT_TAG}")
 
     echo "Beat hosts to turn off: $BEAT_MAINT_HOSTS"
     ansible-playbook -vvvv webservers-${DEPLOY_ENV}.yml --tags "maintenance_mode_on" -e "maintenance_mode=yes" --private-key=$PRIVATE_KEY_FILE --limit $BEAT_MAINT_HOSTS
@@ -30,6 +30,11 @@ the AWS_PROFILE variable:
 
 For more details, see: http://docs.pythonboto.org/en/latest/boto_config_tut.html
 
+To avoid reading the settings and the cache on every call, run this script as
+a daemon that keeps the inventory in memory (see daemon_socket in ec2.ini):
+
+    ec2.py --serve &
+
 When run against a specific host, this script returns the following variables:
  - ec2_ami_launch_index
  - ec2_architecture
@@ -122,36 +127,261 @@ Security groups are comma-separated in 'ec2_security_group_ids' and
 import sys
 import os
 import argparse
+import errno
+import fcntl
+import hashlib
+import marshal
+import mmap
+import random
 import re
-from time import time
+import signal
+import socket
+import struct
+import subprocess
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from time import sleep, time
+import six
+from six.moves import intern
+from six.moves import socketserver
+from six.moves import configparser
+from collections import defaultdict
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+def get_daemon_identity(profile):
+    ''' Returns what tells the credentials an inventory daemon and its
+    clients run with apart: the boto profile, AWS_PROFILE and a hash of the
+    AWS_ACCESS_KEY_ID, which is not sent over the socket as it is '''
+
+    access_key_id = os.environ.get('AWS_ACCESS_KEY_ID', '')
+    return [profile or '', os.environ.get('AWS_PROFILE', ''),
+            hashlib.sha256(access_key_id.encode('utf-8')).hexdigest() if access_key_id else '']
+
+
+def query_inventory_daemon(argv):
+    ''' Asks an inventory daemon (ec2.py --serve) listening on daemon_socket
+    for the output of --list, --host, --query or --refresh-cache. This runs before
+    Ec2Inventory is created, so that a daemon can answer without the cost of
+    reading the settings and the cache. Returns the output, or None if there is
+    no daemon, it runs with different settings, or it cannot answer (e.g. a
+    host it does not know), in which case the script carries on as usual. A
+    query the daemon cannot parse is reported and exits, as it would without
+    the daemon. '''
+
+    (command, argument, profile) = ('list', '', '')
+    args = list(argv)
+    while args:
+        arg = args.pop(0)
+        if arg == '--list':
+            pass
+        elif arg == '--refresh-cache' and command == 'list':
+            command = 'refresh'
+        elif arg == '--host' and args and command == 'list':
+            (command, argument) = ('host', args.pop(0))
+        elif arg == '--query' and args and command == 'list':
+            (command, argument) = ('query', args.pop(0))
+        elif arg in ('--profile', '--boto-profile') and args:
+            profile = args.pop(0)
+        else:
+            return None
+
+    ec2_default_ini_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ec2.ini')
+    ec2_ini_path = os.path.expanduser(os.path.expandvars(os.environ.get('EC2_INI_PATH', ec2_default_ini_path)))
+    try:
+        with open(ec2_ini_path, 'rb') as ini_file:
+            settings = ini_file.read()
+    except IOError:
+        return None
+
+    config = configparser.RawConfigParser()
+    config.read(ec2_ini_path)
+    if not config.has_option('ec2', 'daemon_socket') or not config.get('ec2', 'daemon_socket'):
+        return None
+
+    # The daemon only answers if it would produce the same inventory as
+    # this process, i.e. it runs with the same settings and credentials
+    request = '\t'.join([command, argument, hashlib.md5(settings).hexdigest()] + get_daemon_identity(profile))
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(os.path.expanduser(config.get('ec2', 'daemon_socket')))
+        connection.sendall((request + '\n').encode('utf-8'))
+        chunks = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        connection.close()
+
+    (status, _, output) = b''.join(chunks).partition(b'\n')
+    if status == b'failed':
+        sys.stderr.write(output.decode('utf-8'))
+        sys.exit(1)
+    if status != b'ok':
+        return None
+    return output.decode('utf-8')
+
+
+# Asking an inventory daemon only needs the imports above, so that the
+# client gets its answer before paying for boto and Ansible's imports
+if __name__ == '__main__':
+    daemon_output = query_inventory_daemon(sys.argv[1:])
+    if daemon_output is not None:
+        sys.stdout.write(daemon_output)
+        sys.exit(0)
+
 import boto
 from dateutil import parser
+from dateutil import tz
 from boto import ec2
 from boto import rds
 from boto import elasticache
 from boto import route53
-import six
 
 from ansible.module_utils import ec2 as ec2_utils
 
 HAS_BOTO3 = False
 try:
     import boto3
+    import botocore.exceptions
     HAS_BOTO3 = True
 except ImportError:
     pass
 
-from six.moves import configparser
-from collections import defaultdict
 
-try:
-    import json
-except ImportError:
-    import simplejson as json
+def call_capturing_errors(call):
+    ''' Runs a (function, args) pair on a worker thread. Returns a
+    (succeeded, value) pair where value is either the result or the
+    exc_info of whatever was raised, so that errors (including SystemExit)
+    reach the thread that is waiting on the pool instead of killing the
+    worker. '''
+
+    func, args = call
+    try:
+        return True, func(*args)
+    except BaseException:
+        return False, sys.exc_info()
+
+
+class ApiEndpoint(object):
+    ''' Paces the API calls made to one AWS endpoint (a service in a region):
+    at most max_concurrency of them at a time, and at most rate per second,
+    through a token bucket. The rate is halved whenever AWS throttles a call
+    and raised back gradually as calls succeed. Without a rate, calls are
+    not paced until AWS first throttles one. '''
+
+    # Rate an endpoint without a rate of its own is paced at once AWS
+    # throttles it, and the rate at which it goes back to not being paced
+    throttled_rate = 10.0
+    unthrottled_rate = 40.0
+
+    # Lowest rate, and the factor the rate grows by with each call that succeeds
+    min_rate = 0.5
+    recovery = 1.05
+
+    def __init__(self, max_concurrency, rate=None):
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.max_rate = rate or None
+        self.rate = self.max_rate
+        self.tokens = max(self.rate or 0.0, 1.0)
+        self.updated = time()
+
+    def acquire(self):
+        ''' Waits for a token, then for a free slot '''
+
+        while True:
+            with self.lock:
+                if self.rate is None:
+                    break
+                now = time()
+                self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+        self.semaphore.acquire()
+
+    def release(self, throttled=False):
+        ''' Frees the slot of a call, and adapts the rate to whether AWS
+        throttled it '''
+
+        self.semaphore.release()
+
+        with self.lock:
+            if throttled:
+                self.rate = max(self.min_rate, self.rate / 2 if self.rate else self.throttled_rate)
+                self.tokens = 0.0
+                self.updated = time()
+            elif self.rate is not None and self.rate != self.max_rate:
+                self.rate *= self.recovery
+                if self.rate >= (self.max_rate or self.unthrottled_rate):
+                    self.rate = self.max_rate
+
+
+class InventoryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Unix socket server of the inventory daemon (ec2.py --serve) '''
+
+    daemon_threads = True
+
+
+class InventoryRequestHandler(socketserver.StreamRequestHandler):
+    ''' Answers a single request sent by query_inventory_daemon() '''
+
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8')
+        self.wfile.write(self.server.inventory.answer_daemon_request(request).encode('utf-8'))
 
 
 class Ec2Inventory(object):
 
+    # Instance attributes that Route53 records may point at
+    route53_instance_attributes = ['public_dns_name', 'private_dns_name',
+                                   'ip_address', 'private_ip_address']
+
+    # Launch times as AWS return them, e.g. 2017-06-01T12:00:00.000Z
+    launch_time_format = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d{1,6}))?Z$')
+
+    # Number of group names to_safe() remembers. Most names (tag keys and
+    # values, instance types, AMIs, ...) are shared by many instances.
+    safe_words_max = 65536
+
+    # Error codes AWS APIs throttle calls with
+    api_throttling_errors = frozenset(['RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                                       'ThrottledException', 'RequestThrottled', 'RequestThrottledException',
+                                       'TooManyRequestsException', 'PriorRequestNotComplete', 'SlowDown'])
+
+    # Error codes the tags of an RDS cluster that is (still being) deleted
+    # are not listed with
+    rds_cluster_missing_errors = frozenset(['DBClusterNotFoundFault', 'InvalidDBClusterStateFault'])
+
+    # Delay before the first retry of an API call, and the longest delay
+    # between retries, in seconds
+    api_retry_base_delay = 0.5
+    api_retry_max_delay = 20.0
+
+    # Phases of a refresh, in the order refresh_report lists them
+    refresh_phases = ['fetch', 'add', 'merge', 'serialize']
+
+    # End of a compact cache file: the lengths of the inventory's JSON and of
+    # the index of its records that follows it (see write_compact_cache)
+    compact_cache_trailer = struct.Struct('>QQ')
+
     def _empty_inventory(self):
         return {"_meta" : {"hostvars" : {}}}
 
@@ -171,6 +401,28 @@ class Ec2Inventory(object):
         # AWS credentials.
         self.credentials = {}
 
+        # boto3 clients, by service and region, and the AWS account id
+        self.boto3_clients = {}
+        self.boto3_clients_lock = threading.Lock()
+        self.account_id = None
+        self.account_id_lock = threading.Lock()
+
+        # Pacing of the API calls to each service in each region
+        self.api_endpoints = {}
+        self.api_endpoints_lock = threading.Lock()
+
+        # Statistics of the API calls and phases of the refresh being
+        # reported on (see refresh_report), None when there is none
+        self.api_stats = None
+        self.api_stats_lock = threading.Lock()
+        self.phase_times = None
+
+        # Thread pools the concurrent calls of a refresh share (see
+        # sharing_worker_pools), None outside of a refresh, and how deep in
+        # them the current thread is
+        self.worker_pools = None
+        self.worker_local = threading.local()
+
         # Read settings and parse CLI arguments
         self.parse_cli_args()
         self.read_settings()
@@ -181,39 +433,246 @@ class Ec2Inventory(object):
             if not hasattr(boto.ec2.EC2Connection, 'profile_name'):
                 self.fail_with_error("boto version must be >= 2.24 to use profile")
 
-        # Cache
+        if self.args.serve:
+            self.serve()
+            return
+
+        # Cache. A cache that is stale but not yet past cache_stale_max_age
+        # is used as it is, while it is refreshed in the background. Single
+        # host lookups only fall back to the API for hosts the cache lacks.
         if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
-        elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+            self.update_cache()
+        elif self.args.revalidate_cache:
+            self.update_cache(wait=False)
+            return
+        elif self.is_cache_valid():
+            pass
+        elif self.is_cache_valid(self.cache_stale_max_age):
+            self.revalidate_cache_in_background()
+        else:
+            self.update_cache()
 
         # Data to print
         if self.args.host:
             data_to_print = self.get_host_info()
 
+        elif self.args.query:
+            data_to_print = self.get_query_result(self.args.query)
+
         elif self.args.list:
-            # Display list of instances for inventory
-            if self.inventory == self._empty_inventory():
-                data_to_print = self.get_inventory_from_cache()
-            else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+            # Display list of instances for inventory. The cache holds exactly
+            # what --list prints, whether it was just written or not, so it is
+            # copied to stdout as it is rather than decoded and encoded again.
+            self.write_inventory_from_cache(sys.stdout)
+            return
 
         print(data_to_print)
 
 
-    def is_cache_valid(self):
+    def is_cache_valid(self, max_age=None):
         ''' Determines if the cache files have expired, or if it is still valid '''
 
+        if max_age is None:
+            max_age = self.cache_max_age
+
         if os.path.isfile(self.cache_path_cache):
             mod_time = os.path.getmtime(self.cache_path_cache)
             current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
+            if (mod_time + max_age) > current_time:
                 if os.path.isfile(self.cache_path_index):
                     return True
 
         return False
 
 
+    def update_cache(self, wait=True):
+        ''' Refreshes the cache while holding an exclusive lock on it, so that
+        only one process refreshes at a time. A process that has to wait for
+        the lock reuses the cache written by the process it waited for,
+        rather than refreshing it again. Without wait, the refresh is skipped
+        if another process is already refreshing, or if the cache has been
+        refreshed since it went stale. '''
+
+        lock = open(self.cache_path_lock, 'a')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                if not wait:
+                    return
+                cache_mod_time = self.get_cache_mod_time()
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if self.get_cache_mod_time() != cache_mod_time and self.is_cache_complete():
+                    return
+
+            if not wait and self.is_cache_valid():
+                return
+
+            with self.reporting_refresh(), self.sharing_worker_pools():
+                self.do_api_calls_update_cache()
+        finally:
+            lock.close()
+
+    def revalidate_cache_in_background(self):
+        ''' Runs this script again with --revalidate-cache, detached from this
+        process, so that the stale cache is refreshed for the next call
+        without this one having to wait for it '''
+
+        command = [sys.executable, os.path.abspath(sys.argv[0]), '--revalidate-cache']
+        if self.args.boto_profile:
+            command.extend(['--profile', self.args.boto_profile])
+
+        devnull = open(os.devnull, 'r+b')
+        try:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, preexec_fn=os.setsid)
+        finally:
+            devnull.close()
+
+    def get_cache_mod_time(self):
+        ''' Returns when the cache was last written, or None if there is none '''
+
+        if os.path.isfile(self.cache_path_cache):
+            return os.path.getmtime(self.cache_path_cache)
+        return None
+
+    def is_cache_complete(self):
+        ''' Determines if all of the cache files are there '''
+
+        return os.path.isfile(self.cache_path_cache) and os.path.isfile(self.cache_path_index)
+
+
+    def serve(self):
+        ''' Runs the inventory daemon: keeps the inventory in memory,
+        refreshes it every daemon_refresh_interval seconds, and answers the
+        requests query_inventory_daemon() sends to daemon_socket until it is
+        interrupted '''
+
+        if not self.daemon_socket:
+            self.fail_with_error('daemon_socket must be set in ec2.ini to use --serve')
+
+        if os.path.exists(self.daemon_socket):
+            # Left behind by a daemon that did not shut down cleanly?
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.daemon_socket)
+            except socket.error:
+                os.unlink(self.daemon_socket)
+            else:
+                self.fail_with_error('An inventory daemon is already listening on %s' % self.daemon_socket)
+            finally:
+                probe.close()
+
+        self.daemon_identity = [self.settings_signature] + get_daemon_identity(self.args.boto_profile)
+        self.daemon_refresh_lock = threading.RLock()
+        self.update_served_inventory(refresh=not self.is_cache_valid())
+
+        refresher = threading.Thread(target=self.refresh_served_inventory_periodically)
+        refresher.daemon = True
+        refresher.start()
+
+        # Only the user running the daemon may query it
+        umask = os.umask(0o077)
+        try:
+            server = InventoryServer(self.daemon_socket, InventoryRequestHandler)
+        finally:
+            os.umask(umask)
+        server.inventory = self
+
+        # Clean up the socket when stopped with SIGTERM as well as with ^C
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self.daemon_socket)
+
+    def update_served_inventory(self, refresh=True, full=False):
+        ''' Refreshes the cache (incrementally, unless full) and makes the
+        inventory in it the one the daemon serves. Without refresh, the cache
+        is served as it is. '''
+
+        with self.daemon_refresh_lock:
+            self.inventory = self._empty_inventory()
+            self.index = {}
+            self.args.refresh_cache = full
+            if refresh:
+                self.update_cache()
+
+            # Another process may have refreshed the cache for us
+            if self.inventory == self._empty_inventory():
+                self.inventory = json.loads(self.get_inventory_from_cache())
+
+            self.served_inventory = (self.json_format_dict(self.inventory, self.cache_format == 'json') + '\n',
+                                     self.inventory)
+            self.served_time = os.path.getmtime(self.cache_path_cache)
+
+    def update_stale_served_inventory(self):
+        ''' Refreshes the served inventory if it is older than
+        daemon_refresh_interval, e.g. because the last periodic refresh
+        failed or has not caught up yet '''
+
+        with self.daemon_refresh_lock:
+            if self.served_time + self.daemon_refresh_interval <= time():
+                self.update_served_inventory()
+
+    def refresh_served_inventory_periodically(self):
+        ''' Refreshes the served inventory every daemon_refresh_interval
+        seconds, unless a request has just done so. A refresh that fails
+        leaves the last inventory in place. '''
+
+        while True:
+            sleep(self.daemon_refresh_interval)
+            try:
+                self.update_stale_served_inventory()
+            except SystemExit:
+                # fail_with_error() has already said why
+                sys.stderr.write('\n')
+            except Exception:
+                traceback.print_exc()
+
+    def answer_daemon_request(self, request):
+        ''' Returns the response to a request sent by query_inventory_daemon():
+        'ok' and the output on the lines that follow, 'miss' for a host the
+        daemon does not know, 'failed' and the error message for a query it
+        cannot parse, or 'error' '''
+
+        fields = request.rstrip('\n').split('\t')
+        if len(fields) != 6 or fields[2:] != self.daemon_identity:
+            return 'error\n'
+        (command, argument) = fields[:2]
+
+        if command not in ('refresh', 'list', 'host', 'query'):
+            return 'error\n'
+        try:
+            if command == 'refresh':
+                self.update_served_inventory(full=True)
+            else:
+                self.update_stale_served_inventory()
+        except (Exception, SystemExit):
+            return 'error\n'
+
+        (list_output, inventory) = self.served_inventory
+        if command == 'host':
+            hostvars = inventory['_meta']['hostvars']
+            if argument not in hostvars:
+                return 'miss\n'
+            return 'ok\n' + self.json_format_dict(hostvars[argument], True) + '\n'
+        elif command == 'query':
+            try:
+                hosts = self.query_hosts(argument, lambda name: inventory.get(name) if name != '_meta' else None,
+                                         lambda: [name for name in inventory if name != '_meta'])
+            except (ValueError, re.error) as e:
+                # Reported by the client, as get_query_result() would
+                return 'failed\nERROR: "{0}", while: querying groups'.format(e)
+            return 'ok\n' + (','.join(hosts) + ',' if hosts else '') + '\n'
+        return 'ok\n' + list_output
+
+
     def read_settings(self):
         ''' Reads the settings from the ec2.ini file '''
         if six.PY3:
@@ -224,6 +683,14 @@ class Ec2Inventory(object):
         ec2_ini_path = os.path.expanduser(os.path.expandvars(os.environ.get('EC2_INI_PATH', ec2_default_ini_path)))
         config.read(ec2_ini_path)
 
+        # Fingerprint of the settings, so that cached instance records built
+        # with different settings are not reused
+        settings_hash = hashlib.md5()
+        if os.path.isfile(ec2_ini_path):
+            with open(ec2_ini_path, 'rb') as ini_file:
+                settings_hash.update(ini_file.read())
+        self.settings_signature = settings_hash.hexdigest()
+
         # is eucalyptus?
         self.eucalyptus_host = None
         self.eucalyptus = False
@@ -269,6 +736,9 @@ class Ec2Inventory(object):
         if config.has_option('ec2', 'route53_excluded_zones'):
             self.route53_excluded_zones.extend(
                 config.get('ec2', 'route53_excluded_zones', '').split(','))
+        self.route53_cache_max_age = 0
+        if config.has_option('ec2', 'route53_cache_max_age'):
+            self.route53_cache_max_age = config.getint('ec2', 'route53_cache_max_age')
 
         # Include RDS instances?
         self.rds_enabled = True
@@ -382,7 +852,98 @@ class Ec2Inventory(object):
             cache_name = '%s-%s' % (cache_name, aws_profile())
         self.cache_path_cache = cache_dir + "/%s.cache" % cache_name
         self.cache_path_index = cache_dir + "/%s.index" % cache_name
+        self.cache_path_snapshot = cache_dir + "/%s.snapshot" % cache_name
+        self.cache_path_lock = cache_dir + "/%s.lock" % cache_name
+        self.cache_path_route53 = cache_dir + "/%s.route53" % cache_name
+        self.cache_path_account = cache_dir + "/%s.account" % cache_name
+        self.cache_path_shards = cache_dir + "/%s" % cache_name
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
+        if os.environ.get('EC2_CACHE_MAX_AGE'):
+            self.cache_max_age = int(os.environ['EC2_CACHE_MAX_AGE'])
+
+        # Until this age a stale cache is still used, and refreshed in the
+        # background. Past it, the cache is refreshed before it is used.
+        self.cache_stale_max_age = self.cache_max_age
+        if config.has_option('ec2', 'cache_stale_max_age'):
+            self.cache_stale_max_age = config.getint('ec2', 'cache_stale_max_age')
+        if os.environ.get('EC2_CACHE_STALE_MAX_AGE'):
+            self.cache_stale_max_age = int(os.environ['EC2_CACHE_STALE_MAX_AGE'])
+        self.cache_stale_max_age = max(self.cache_stale_max_age, self.cache_max_age)
+
+        # RDS and ElastiCache change far less often than EC2 instances, so
+        # their shards of the cache can be kept for longer
+        self.service_cache_max_age = {'ec2': self.cache_max_age}
+        for service in ['rds', 'elasticache']:
+            self.service_cache_max_age[service] = self.cache_max_age
+            if config.has_option('ec2', '%s_cache_max_age' % service):
+                self.service_cache_max_age[service] = max(config.getint('ec2', '%s_cache_max_age' % service),
+                                                          self.cache_max_age)
+
+        # Report on the API calls and phases of every refresh
+        self.refresh_report = None
+        if config.has_option('ec2', 'refresh_report'):
+            self.refresh_report = config.get('ec2', 'refresh_report')
+        if os.environ.get('EC2_REFRESH_REPORT'):
+            self.refresh_report = os.environ['EC2_REFRESH_REPORT']
+        if self.refresh_report and self.refresh_report != 'stderr':
+            self.refresh_report = os.path.expanduser(self.refresh_report)
+
+        # Directory of the Ansible jsonfile fact cache to write the facts of
+        # every instance to (see write_fact_cache), None when there is none
+        self.fact_cache_path = None
+        if config.has_option('ec2', 'fact_cache_path'):
+            self.fact_cache_path = config.get('ec2', 'fact_cache_path')
+        if os.environ.get('EC2_FACT_CACHE_PATH'):
+            self.fact_cache_path = os.environ['EC2_FACT_CACHE_PATH']
+        if self.fact_cache_path:
+            self.fact_cache_path = os.path.expanduser(self.fact_cache_path)
+
+        # Inventory daemon (--serve)
+        self.daemon_socket = None
+        if config.has_option('ec2', 'daemon_socket') and config.get('ec2', 'daemon_socket'):
+            self.daemon_socket = os.path.expanduser(config.get('ec2', 'daemon_socket'))
+        self.daemon_refresh_interval = 300
+        if config.has_option('ec2', 'daemon_refresh_interval'):
+            self.daemon_refresh_interval = config.getint('ec2', 'daemon_refresh_interval')
+
+        # Cache file format: compact JSON with separately readable records
+        # for each host and group, or pretty printed JSON
+        self.cache_format = 'compact'
+        if config.has_option('ec2', 'cache_format'):
+            self.cache_format = config.get('ec2', 'cache_format')
+        if self.cache_format not in ['json', 'compact']:
+            self.fail_with_error("cache_format must be 'json' or 'compact', not '%s'" % self.cache_format)
+
+        # Number of API calls made concurrently when refreshing the cache
+        if config.has_option('ec2', 'refresh_workers'):
+            self.refresh_workers = config.getint('ec2', 'refresh_workers')
+        else:
+            self.refresh_workers = 8
+
+        # Retries of throttled API calls, and the pacing of the calls to each
+        # service in each region: how many are made at a time, and how many
+        # per second (0: as many as AWS allows before throttling)
+        self.api_max_retries = 5
+        if config.has_option('ec2', 'api_max_retries'):
+            self.api_max_retries = config.getint('ec2', 'api_max_retries')
+        self.api_max_concurrency = max(self.refresh_workers, 1)
+        if config.has_option('ec2', 'api_max_concurrency'):
+            self.api_max_concurrency = max(config.getint('ec2', 'api_max_concurrency'), 1)
+        self.api_rate_limit = 0.0
+        if config.has_option('ec2', 'api_rate_limit'):
+            self.api_rate_limit = config.getfloat('ec2', 'api_rate_limit')
+
+        # Only re-process the instances that changed since the last refresh?
+        if config.has_option('ec2', 'incremental_refresh'):
+            self.incremental_refresh = config.getboolean('ec2', 'incremental_refresh')
+        else:
+            self.incremental_refresh = False
+
+        # Use the tags returned with the instances instead of fetching them again?
+        if config.has_option('ec2', 'trust_instance_tags'):
+            self.trust_instance_tags = config.getboolean('ec2', 'trust_instance_tags')
+        else:
+            self.trust_instance_tags = False
 
         if config.has_option('ec2', 'expand_csv_tags'):
             self.expand_csv_tags = config.getboolean('ec2', 'expand_csv_tags')
@@ -401,6 +962,13 @@ class Ec2Inventory(object):
         else:
             self.replace_dash_in_groups = True
 
+        # Characters to_safe() replaces, and the names it has converted
+        regex = "[^A-Za-z0-9\_"
+        if not self.replace_dash_in_groups:
+            regex += "\-"
+        self.unsafe_chars = re.compile(regex + "]")
+        self.safe_words = {}
+
         # Configure which groups should be created.
         group_by_options = [
             'group_by_instance_id',
@@ -472,29 +1040,410 @@ class Ec2Inventory(object):
                            help='Get all the variables about a specific instance')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                            help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+        parser.add_argument('--query', action='store',
+                           help='List the hosts matched by a group query as a comma separated list, '
+                                "e.g. 'tag_Group_web_server_dev:!tag_Name_web_server_dev_1' or "
+                                "'~tag_Name_(celerybeat|web_server)_dev'")
         parser.add_argument('--profile', '--boto-profile', action='store', dest='boto_profile',
                            help='Use boto profile for connections to EC2')
+        parser.add_argument('--revalidate-cache', action='store_true', default=False,
+                           help=argparse.SUPPRESS)
+        parser.add_argument('--serve', action='store_true', default=False,
+                           help='Keep the inventory in memory and answer --list and --host from it '
+                                'through daemon_socket (see ec2.ini)')
         self.args = parser.parse_args()
 
 
     def do_api_calls_update_cache(self):
         ''' Do API calls to each region, and save data in cache files '''
 
-        if self.route53_enabled:
-            self.get_route53_records()
-
+        # In incremental mode the instance records from the previous refresh
+        # are reused for every instance that has not changed since
+        self.instance_snapshot = {}
+        if self.incremental_refresh and not self.args.refresh_cache:
+            self.instance_snapshot = self.load_instance_snapshot()
+
+        # The cache is sharded by region and service. Only the shards with a
+        # max age longer than the whole cache's (rds_cache_max_age,
+        # elasticache_cache_max_age) are kept in cache files of their own, and
+        # reused until it has passed. The others, including the EC2 shards,
+        # could never be reused as this runs once the whole cache is older
+        # than cache_max_age: they are fetched again, as is every shard with
+        # --refresh-cache.
+        shards = self.get_cache_shards()
+        cached_shards = {}
+        for region, service, fetches in shards:
+            if self.args.refresh_cache or not self.is_cache_shard_kept(service):
+                continue
+            shard = self.load_cache_shard(region, service)
+            if shard is not None:
+                cached_shards[(region, service)] = shard
+
+        # Every (region, service) pair is fetched concurrently, but the results
+        # are merged in the order a serial refresh would have used so that the
+        # inventory does not depend on which API call happened to finish first
+        jobs = []
+        if self.route53_enabled and any(service == 'ec2' and (region, service) not in cached_shards
+                                        for region, service, fetches in shards):
+            jobs.append((self.get_route53_records, None))
+
+        for region, service, fetches in shards:
+            if (region, service) not in cached_shards:
+                jobs.extend((fetch, region) for fetch, add in fetches)
+
+        # This includes building the instance records, as their tags arrive
+        with self.time_phase('fetch'):
+            results = dict(zip(jobs, self.run_concurrently([(fetch, (region,) if region else ())
+                                                            for fetch, region in jobs])))
+
+        for region, service, fetches in shards:
+            if (region, service) in cached_shards:
+                (inventory, index) = cached_shards[(region, service)]
+            else:
+                with self.time_phase('add'):
+                    self.inventory = self._empty_inventory()
+                    self.index = {}
+                    for fetch, add in fetches:
+                        add(results[(fetch, region)], region)
+                    (inventory, index) = (self.inventory, self.index)
+                if self.is_cache_shard_kept(service):
+                    shard = {'settings': self.settings_signature, 'inventory': inventory, 'index': index}
+                    with self.time_phase('serialize'):
+                        self.write_to_cache(shard, self.get_cache_shard_path(region, service))
+            cached_shards[(region, service)] = (inventory, index)
+
+        with self.time_phase('merge'):
+            self.inventory = self._empty_inventory()
+            self.index = {}
+            for region, service, fetches in shards:
+                (inventory, index) = cached_shards[(region, service)]
+                self.merge_inventory(self.inventory, inventory, index)
+                self.index.update(index)
+
+        with self.time_phase('serialize'):
+            if self.cache_format == 'compact':
+                self.write_compact_cache(self.inventory)
+            else:
+                self.write_to_cache(self.inventory, self.cache_path_cache)
+            self.write_to_cache(self.index, self.cache_path_index)
+            if self.incremental_refresh:
+                self.write_to_cache({'settings': self.settings_signature, 'cache': self.get_cache_stamp(),
+                                     'regions': self.instance_snapshot}, self.cache_path_snapshot)
+            if self.fact_cache_path:
+                self.write_fact_cache(self.inventory)
+
+    def get_cache_shards(self):
+        ''' Returns the shards of the cache as (region, service, fetches)
+        tuples, in the order they are merged, where fetches are the (fetch,
+        add) pairs of functions that get the shard's resources from AWS and
+        add them to the inventory '''
+
+        shards = []
         for region in self.regions:
-            self.get_instances_by_region(region)
+            shards.append((region, 'ec2', [(self.get_instances_by_region, self.add_instances)]))
             if self.rds_enabled:
-                self.get_rds_instances_by_region(region)
+                fetches = [(self.get_rds_instances_by_region, self.add_rds_instances)]
+                if self.include_rds_clusters:
+                    fetches.append((self.include_rds_clusters_by_region, self.add_rds_clusters))
+                shards.append((region, 'rds', fetches))
             if self.elasticache_enabled:
-                self.get_elasticache_clusters_by_region(region)
-                self.get_elasticache_replication_groups_by_region(region)
-            if self.include_rds_clusters:
-                self.include_rds_clusters_by_region(region)
+                shards.append((region, 'elasticache', [
+                    (self.get_elasticache_clusters_by_region, self.add_elasticache_clusters),
+                    (self.get_elasticache_replication_groups_by_region, self.add_elasticache_replication_groups),
+                ]))
+        return shards
+
+    def is_cache_shard_kept(self, service):
+        ''' Returns whether the shards of a service are kept in cache files,
+        i.e. whether they outlive the cache that is merged from them '''
+
+        return self.service_cache_max_age[service] > self.cache_max_age
 
-        self.write_to_cache(self.inventory, self.cache_path_cache)
-        self.write_to_cache(self.index, self.cache_path_index)
+    def get_cache_shard_path(self, region, service):
+        ''' Returns the path of the cache file of a shard, e.g.
+        ansible-ec2.us-east-1.rds '''
+
+        return '%s.%s.%s' % (self.cache_path_shards, region, service)
+
+    def load_cache_shard(self, region, service):
+        ''' Reads the inventory and index of a shard from its cache file, or
+        returns None if it is missing, older than the service's max age or
+        was written with different settings '''
+
+        path = self.get_cache_shard_path(region, service)
+        try:
+            if os.path.getmtime(path) + self.service_cache_max_age[service] <= time():
+                return None
+            with open(path, 'r') as cache:
+                shard = json.loads(cache.read())
+        except (OSError, IOError, ValueError):
+            return None
+
+        if shard.get('settings') != self.settings_signature:
+            return None
+
+        return (shard['inventory'], shard['index'])
+
+    def merge_inventory(self, inventory, shard, index):
+        ''' Adds the groups and host variables of a shard to the inventory,
+        as if the shard's resources had been pushed onto it one by one. The
+        groups named after a resource's id (e.g. an ElastiCache cluster found
+        in two regions) are always a group of 1, so the shard's replaces the
+        inventory's, and hosts already in a group are not added to it again.
+        The shard's index tells its resources' ids. '''
+
+        ids = set(resource_id for region, resource_id in index.values())
+        for key, value in shard.items():
+            if key == '_meta':
+                inventory['_meta']['hostvars'].update(value['hostvars'])
+            elif key not in inventory:
+                inventory[key] = value
+            elif key in ids and isinstance(value, list):
+                inventory[key] = value
+            elif isinstance(inventory[key], list) and isinstance(value, list):
+                self.extend_hosts(inventory[key], value)
+            else:
+                if not isinstance(inventory[key], dict):
+                    inventory[key] = {'hosts': inventory[key]}
+                if not isinstance(value, dict):
+                    value = {'hosts': value}
+                group = inventory[key]
+                for name, element in value.items():
+                    if name == 'hosts':
+                        self.extend_hosts(group.setdefault('hosts', []), element)
+                    elif name == 'children':
+                        children = group.setdefault('children', [])
+                        children.extend(child for child in element if child not in children)
+                    else:
+                        group[name] = element
+
+    def api_call(self, service, region, func, *args, **kwargs):
+        ''' Makes an AWS API call, paced by the endpoint of the service in the
+        region (see ApiEndpoint). Calls that AWS throttles or fails with a
+        server error are retried up to api_max_retries times, after a random
+        delay of up to twice as long each time (exponential backoff with full
+        jitter). While a refresh is being reported on, the number of calls,
+        the errors and retries, the time they took and the number of items
+        they returned are recorded per service, region and method. '''
+
+        endpoint = self.get_api_endpoint(service, region)
+        start = time()
+        retries = 0
+        while True:
+            endpoint.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                (throttled, retryable) = self.get_api_error_kind(e)
+                endpoint.release(throttled)
+                if not retryable or retries >= self.api_max_retries:
+                    if self.api_stats is not None:
+                        self.record_api_call(service, region, func.__name__, time() - start, None,
+                                             failed=True, retries=retries)
+                    raise
+            else:
+                endpoint.release()
+                if self.api_stats is not None:
+                    self.record_api_call(service, region, func.__name__, time() - start, result, retries=retries)
+                return result
+
+            retries += 1
+            sleep(random.uniform(0, min(self.api_retry_max_delay, self.api_retry_base_delay * 2 ** retries)))
+
+    def get_api_endpoint(self, service, region):
+        ''' Returns the ApiEndpoint that paces the calls to a service in a
+        region, shared by all of the threads '''
+
+        with self.api_endpoints_lock:
+            if (service, region) not in self.api_endpoints:
+                self.api_endpoints[(service, region)] = ApiEndpoint(self.api_max_concurrency, self.api_rate_limit)
+            return self.api_endpoints[(service, region)]
+
+    def get_api_error_kind(self, error):
+        ''' Returns whether an error raised by an API call means that AWS
+        throttled it, and whether the call is worth retrying: throttled calls
+        and server errors are '''
+
+        if isinstance(error, boto.exception.BotoServerError):
+            (code, status) = (error.error_code, error.status)
+        else:
+            # botocore's ClientError
+            response = getattr(error, 'response', None)
+            if not isinstance(response, dict):
+                return (False, False)
+            code = response.get('Error', {}).get('Code')
+            status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+
+        throttled = code in self.api_throttling_errors
+        return (throttled, throttled or (isinstance(status, int) and status >= 500))
+
+    def record_api_call(self, service, region, method, elapsed, result, failed=False, retries=0):
+        ''' Adds an API call to the statistics of the refresh being reported
+        on '''
+
+        items = self.get_response_size(result)
+        with self.api_stats_lock:
+            stats = self.api_stats.setdefault((service, region or '', method), {
+                'calls': 0, 'errors': 0, 'retries': 0, 'time': 0.0, 'max_time': 0.0, 'items': 0})
+            stats['calls'] += 1
+            stats['errors'] += int(failed)
+            stats['retries'] += retries
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['items'] += items
+
+    def get_response_size(self, response):
+        ''' Returns the number of items in an API response: the length of a
+        list, or the total length of the lists in a dict, as boto returns the
+        responses of ElastiCache and boto3 does '''
+
+        if isinstance(response, list):
+            return len(response)
+        elif isinstance(response, dict):
+            return sum(self.get_response_size(value) for value in response.values())
+        return 0
+
+    @contextmanager
+    def reporting_refresh(self):
+        ''' With refresh_report set, records the API calls and phases of the
+        refresh made in the block, and reports on them once it is done, or
+        has failed '''
+
+        if not self.refresh_report:
+            yield
+            return
+
+        self.api_stats = {}
+        self.phase_times = {}
+        start = time()
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            self.write_refresh_report(start, time() - start, succeeded)
+            self.api_stats = None
+            self.phase_times = None
+
+    @contextmanager
+    def time_phase(self, phase):
+        ''' Adds the time the block takes to a phase of the refresh being
+        reported on '''
+
+        start = time()
+        try:
+            yield
+        finally:
+            if self.phase_times is not None:
+                self.phase_times[phase] = self.phase_times.get(phase, 0.0) + time() - start
+
+    def write_refresh_report(self, start, elapsed, succeeded):
+        ''' Reports on the API calls and phases of a refresh: as a table on
+        stderr, or as a line of JSON appended to the refresh_report file '''
+
+        calls = []
+        for (service, region, method), stats in sorted(self.api_stats.items()):
+            call = {'service': service, 'region': region, 'method': method}
+            call.update(stats)
+            calls.append(call)
+        phases = [(phase, self.phase_times[phase]) for phase in self.refresh_phases if phase in self.phase_times]
+
+        if self.refresh_report == 'stderr':
+            lines = ['Refresh %s in %.2fs (%s)' % ('done' if succeeded else 'failed', elapsed,
+                                                 ', '.join('%s %.2fs' % phase for phase in phases)),
+                     '%-12s %-15s %-30s %6s %6s %7s %9s %9s %8s' % ('SERVICE', 'REGION', 'METHOD', 'CALLS', 'ERRORS',
+                                                                   'RETRIES', 'TIME (s)', 'MAX (s)', 'ITEMS')]
+            for call in calls:
+                lines.append('%-12s %-15s %-30s %6d %6d %7d %9.2f %9.2f %8d' % (
+                    call['service'], call['region'] or '-', call['method'], call['calls'], call['errors'],
+                    call['retries'], call['time'], call['max_time'], call['items']))
+            sys.stderr.write('\n'.join(lines) + '\n')
+        else:
+            report = {'start': start, 'time': elapsed, 'succeeded': succeeded, 'phases': dict(phases),
+                      'calls': calls, 'refresh_cache': self.args.refresh_cache}
+            with open(self.refresh_report, 'a') as report_file:
+                report_file.write(json.dumps(report, sort_keys=True) + '\n')
+
+    @contextmanager
+    def sharing_worker_pools(self):
+        ''' Runs the concurrent calls made in the block (see run_concurrently)
+        on two pools of refresh_workers threads, created once: one for the
+        calls made from the main thread, such as the fetches of each region
+        and service, and one for the calls those make in turn, such as the
+        chunks of tags of a region. However many regions there are, a refresh
+        then runs at most twice refresh_workers threads, and no call waits
+        for a thread of the pool it runs on. '''
+
+        if self.refresh_workers <= 1:
+            yield
+            return
+
+        self.worker_pools = [ThreadPool(self.refresh_workers, self.set_worker_depth, (depth,))
+                             for depth in (1, 2)]
+        try:
+            yield
+        finally:
+            (pools, self.worker_pools) = (self.worker_pools, None)
+            for pool in pools:
+                pool.close()
+                pool.join()
+
+    def set_worker_depth(self, depth):
+        ''' Records which of the shared pools the current thread belongs to
+        (1 or 2, 0 for a thread of neither) '''
+
+        self.worker_local.depth = depth
+
+    @contextmanager
+    def worker_pool(self, size):
+        ''' Yields the pool to run size calls concurrently on, or None if they
+        are to run one after another: the shared pool for the depth of the
+        current thread during a refresh (calls made from the second pool are
+        not spread any further), otherwise a pool of their own '''
+
+        if self.refresh_workers <= 1 or size <= 1:
+            yield None
+        elif self.worker_pools is not None:
+            depth = getattr(self.worker_local, 'depth', 0)
+            yield self.worker_pools[depth] if depth < len(self.worker_pools) else None
+        else:
+            pool = ThreadPool(min(self.refresh_workers, size))
+            try:
+                yield pool
+            finally:
+                pool.close()
+                pool.join()
+
+    def run_concurrently(self, calls):
+        ''' Runs a list of (function, args) calls on a pool of refresh_workers
+        threads (see worker_pool) and returns their results in the same
+        order. An error raised by any call, including the SystemExit from
+        fail_with_error, is raised again in the calling thread once all of the
+        calls have finished. '''
+
+        with self.worker_pool(len(calls)) as pool:
+            if pool is None:
+                return [func(*args) for func, args in calls]
+            outcomes = pool.map(call_capturing_errors, calls)
+
+        for succeeded, value in outcomes:
+            if not succeeded:
+                six.reraise(*value)
+
+        return [value for succeeded, value in outcomes]
+
+    def run_as_completed(self, func, items):
+        ''' Calls func on each item on a pool of refresh_workers threads (see
+        worker_pool) and yields the results in the order they complete '''
+
+        with self.worker_pool(len(items)) as pool:
+            if pool is None:
+                for item in items:
+                    yield func(item)
+                return
+
+            for result in pool.imap_unordered(func, items):
+                yield result
 
     def connect(self, region):
         ''' create connection to api server'''
@@ -513,7 +1462,7 @@ class Ec2Inventory(object):
         return connect_args
 
     def connect_to_aws(self, module, region):
-        connect_args = self.credentials
+        connect_args = dict(self.credentials)
 
         # only pass the profile name if it's set (as it is not supported by older boto versions)
         if self.boto_profile:
@@ -528,41 +1477,107 @@ class Ec2Inventory(object):
 
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
-        region '''
+        region and returns their inventory records, most recently launched
+        first, along with the region's new instance snapshot (None unless
+        incremental_refresh is on) '''
 
         try:
             conn = self.connect(region)
             reservations = []
+
+            # Instances in other states are skipped anyway, so leave them out of the response
+            state_filter = {}
+            if not self.all_instances:
+                state_filter['instance-state-name'] = self.ec2_instance_states
+
             if self.ec2_instance_filters:
+                # Each filter key is a separate query, and an instance is
+                # included if it matches any of them. The queries are made
+                # concurrently, and an instance matched by several of them is
+                # only kept once.
+                queries = []
                 for filter_key, filter_values in self.ec2_instance_filters.items():
-                    reservations.extend(conn.get_all_instances(filters = { filter_key : filter_values }))
+                    filters = dict(state_filter)
+                    filters[filter_key] = filter_values
+                    queries.append((self.api_call, ('ec2', region, conn.get_all_instances, None, filters)))
+                for query_reservations in self.run_concurrently(queries):
+                    reservations.extend(query_reservations)
             else:
-                reservations = conn.get_all_instances()
+                reservations = self.api_call('ec2', region, conn.get_all_instances, filters = state_filter or None)
 
-            # Pull the tags back in a second step
-            # AWS are on record as saying that the tags fetched in the first `get_all_instances` request are not
-            # reliable and may be missing, and the only way to guarantee they are there is by calling `get_all_tags`
-            instance_ids = []
+            # Leave out the instances that are skipped whatever their tags,
+            # so that their tags are not fetched
+            all_instances = []
+            instance_ids = set()
             for reservation in reservations:
-                instance_ids.extend([instance.id for instance in reservation.instances])
-
-            max_filter_value = 199
-            tags = []
-            for i in range(0, len(instance_ids), max_filter_value):
-                tags.extend(conn.get_all_tags(filters={'resource-type': 'instance', 'resource-id': instance_ids[i:i+max_filter_value]}))
+                for instance in reservation.instances:
+                    if instance.id not in instance_ids and not self.is_instance_skipped_before_tags(instance):
+                        instance_ids.add(instance.id)
+                        all_instances.append(instance)
+            records = [None] * len(all_instances)
+            fingerprints = [None] * len(all_instances)
+
+            # In incremental mode, the record of an instance that is unchanged
+            # since the last snapshot, down to its tags, is reused rather than
+            # built again
+            previous_snapshot = self.instance_snapshot.get(region, {})
+
+            def reuse_record(position):
+                fingerprints[position] = self.get_instance_fingerprint(all_instances[position])
+                previous = previous_snapshot.get(all_instances[position].id)
+                if previous and previous[0] == fingerprints[position]:
+                    records[position] = previous[1]
+                    return True
+                return False
 
-            tags_by_instance_id = defaultdict(dict)
-            for tag in tags:
-                tags_by_instance_id[tag.res_id][tag.name] = tag.value
+            def update_record(position):
+                if not (self.incremental_refresh and reuse_record(position)):
+                    records[position] = self.get_instance_record(all_instances[position], region)
 
-            all_instances = [instance for reservation in reservations for instance in reservation.instances]
+            if self.trust_instance_tags:
+                for position in range(len(all_instances)):
+                    update_record(position)
+            else:
+                # Pull the tags back in a second step
+                # AWS are on record as saying that the tags fetched in the first `get_all_instances` request are not
+                # reliable and may be missing, and the only way to guarantee they are there is by calling `get_all_tags`
+                # The chunks of tags are fetched concurrently and each chunk's instances are turned into records as
+                # soon as it arrives, while the remaining chunks are still in flight
+                # In incremental mode, the instances returned with the same tags as in the last snapshot, which
+                # are unchanged, are left out of it
+                positions = [position for position in range(len(all_instances))
+                             if not (previous_snapshot and reuse_record(position))]
+                max_filter_value = 199
+                chunks = [positions[i:i + max_filter_value] for i in range(0, len(positions), max_filter_value)]
+
+                def get_tags(chunk):
+                    instance_ids = [all_instances[position].id for position in chunk]
+                    return chunk, self.api_call('ec2', region, conn.get_all_tags,
+                                                filters={'resource-type': 'instance', 'resource-id': instance_ids})
+
+                for chunk, tags in self.run_as_completed(get_tags, chunks):
+                    tags_by_instance_id = defaultdict(dict)
+                    for tag in tags:
+                        tags_by_instance_id[tag.res_id][tag.name] = tag.value
+
+                    for position in chunk:
+                        all_instances[position].tags = tags_by_instance_id[all_instances[position].id]
+                        update_record(position)
+
+            # Instances that no longer exist (e.g. terminated) simply drop out of the snapshot. The host
+            # variables are left out, as they are read back from the cache (see load_instance_snapshot)
+            snapshot = None
+            if self.incremental_refresh:
+                snapshot = {}
+                for position, instance in enumerate(all_instances):
+                    record = records[position]
+                    if record:
+                        record = dict((key, value) for key, value in record.items() if key != 'hostvars')
+                    snapshot[instance.id] = [fingerprints[position], record]
 
             # Force most recently launched instances to the top of the lists
-            all_instances = sorted(all_instances, key=lambda x: parser.parse(x.launch_time), reverse=True)
-
-            for instance in all_instances:
-                instance.tags = tags_by_instance_id[instance.id]
-                self.add_instance(instance, region)
+            records = [record for record in records if record]
+            return sorted(records, key=lambda x: self.get_launch_time_key(x['launch_time']), reverse=True), snapshot
 
         except boto.exception.BotoServerError as e:
             if e.error_code == 'AuthFailure':
@@ -572,19 +1587,49 @@ class Ec2Inventory(object):
                 error = "Error connecting to %s backend.\n%s" % (backend, e.message)
             self.fail_with_error(error, 'getting EC2 instances')
 
+    def add_instances(self, result, region):
+        ''' Adds the instance records fetched for a region to the inventory '''
+
+        records, snapshot = result
+        for record in records:
+            self.add_instance_record(record)
+
+        self.instance_snapshot[region] = snapshot
+
+    def get_instance_fingerprint(self, instance):
+        ''' Summarises an instance as returned by get_all_instances, with the
+        tags of the tag pass, so that a changed instance can be told apart
+        from one whose record can be reused. It holds everything that
+        get_host_info_dict_from_instance reads, which the hostname and groups
+        of the record are worked out from too: every plain attribute of the
+        instance, plus its state, region, placement, security groups and
+        tags. Only a hash of it is kept in the snapshot. '''
+
+        fingerprint = [[key, value] for key, value in sorted(vars(instance).items())
+                       if value is None or isinstance(value, (six.string_types, int, bool))]
+        fingerprint.extend([
+            ['state', instance.state, instance.state_code],
+            ['previous_state', instance.previous_state, instance.previous_state_code],
+            ['region', instance.region.name if instance.region else None],
+            ['placement', instance.placement],
+            ['groups', [[group.id, group.name] for group in instance.groups]],
+            ['tags', sorted(instance.tags.items())],
+        ])
+        return hashlib.md5(json.dumps(fingerprint, separators=(',', ':')).encode('utf-8')).hexdigest()
+
     def get_rds_instances_by_region(self, region):
         ''' Makes an AWS API call to the list of RDS instances in a particular
-        region '''
+        region and returns them '''
 
+        all_instances = []
         try:
             conn = self.connect_to_aws(rds, region)
             if conn:
                 marker = None
                 while True:
-                    instances = conn.get_all_dbinstances(marker=marker)
+                    instances = self.api_call('rds', region, conn.get_all_dbinstances, marker=marker)
                     marker = instances.marker
-                    for instance in instances:
-                        self.add_rds_instance(instance, region)
+                    all_instances.extend(instances)
                     if not marker:
                         break
         except boto.exception.BotoServerError as e:
@@ -596,22 +1641,40 @@ class Ec2Inventory(object):
                 error = "Looks like AWS RDS is down:\n%s" % e.message
             self.fail_with_error(error, 'getting RDS instances')
 
+        return all_instances
+
+    def add_rds_instances(self, instances, region):
+        ''' Adds the RDS instances fetched for a region to the inventory '''
+
+        for instance in instances:
+            self.add_rds_instance(instance, region)
+
     def include_rds_clusters_by_region(self, region):
+        ''' Makes AWS API calls to describe the RDS clusters (Aurora etc.) in a
+        particular region and returns them keyed by cluster identifier '''
+
         if not HAS_BOTO3:
             self.fail_with_error("Working with RDS clusters requires boto3 - please install boto3 and try again",
                                  "getting RDS clusters")
 
-        client = ec2_utils.boto3_inventory_conn('client', 'rds', region, **self.credentials)
+        client = self.get_boto3_client('rds', region)
+
+        # The paginator makes a call per page as the pages are iterated over
+        def describe_db_clusters():
+            return list(client.get_paginator('describe_db_clusters').paginate())
+
+        clusters = []
+        for page in self.api_call('rds', region, describe_db_clusters):
+            clusters.extend(page['DBClusters'])
 
-        marker, clusters = '', []
-        while marker is not None:
-            resp = client.describe_db_clusters(Marker=marker)
-            clusters.extend(resp["DBClusters"])
-            marker = resp.get('Marker', None)
+        # ignore empty clusters caused by AWS bug
+        clusters = [c for c in clusters if len(c['DBClusterMembers']) > 0]
+
+        # The tags of every cluster are fetched concurrently
+        tags = self.run_concurrently([(self.get_rds_cluster_tags, (client, region, c)) for c in clusters])
 
-        account_id = boto.connect_iam().get_user().arn.split(':')[4]
         c_dict = {}
-        for c in clusters:
+        for c, cluster_tags in zip(clusters, tags):
             # remove these datetime objects as there is no serialisation to json
             # currently in place and we don't need the data yet
             if 'EarliestRestorableTime' in c:
@@ -624,11 +1687,8 @@ class Ec2Inventory(object):
             else:
                 matches_filter = False
 
-            try:
-                # arn:aws:rds:<region>:<account number>:<resourcetype>:<name>
-                tags = client.list_tags_for_resource(
-                    ResourceName='arn:aws:rds:' + region + ':' + account_id + ':cluster:' + c['DBClusterIdentifier'])
-                c['Tags'] = tags['TagList']
+            if cluster_tags is not None:
+                c['Tags'] = cluster_tags
 
                 if self.ec2_instance_filters:
                     for filter_key, filter_values in self.ec2_instance_filters.items():
@@ -641,23 +1701,72 @@ class Ec2Inventory(object):
                             # it matches a filter, so stop looking for further matches
                             break
 
-            except Exception as e:
-                if e.message.find('DBInstanceNotFound') >= 0:
-                    # AWS RDS bug (2016-01-06) means deletion does not fully complete and leave an 'empty' cluster.
-                    # Ignore errors when trying to find tags for these
+            if matches_filter:
+                c_dict[c['DBClusterIdentifier']] = c
+
+        return c_dict
+
+    def get_rds_cluster_tags(self, client, region, cluster):
+        ''' Makes an AWS API call to list the tags of an RDS cluster, and
+        returns them, or None if the cluster is gone '''
+
+        # arn:aws:rds:<region>:<account number>:<resourcetype>:<name>
+        arn = cluster.get('DBClusterArn')
+        if not arn:
+            arn = 'arn:aws:rds:' + region + ':' + self.get_account_id(region) + ':cluster:' + cluster['DBClusterIdentifier']
+
+        try:
+            return self.api_call('rds', region, client.list_tags_for_resource, ResourceName=arn)['TagList']
+        except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e:
+            # AWS RDS bug (2016-01-06) means deletion does not fully complete and leave an 'empty' cluster.
+            # Ignore errors when trying to find tags for these
+            code = getattr(e, 'response', {}).get('Error', {}).get('Code')
+            if code in self.rds_cluster_missing_errors:
+                return None
+            self.fail_with_error(str(e), 'getting RDS cluster tags')
+
+    def get_boto3_client(self, service, region):
+        ''' Returns a boto3 client for a service in a region. Clients are
+        created once and reused, by every thread and by later refreshes of
+        the inventory daemon, as creating one loads the service's API model. '''
+
+        with self.boto3_clients_lock:
+            if (service, region) not in self.boto3_clients:
+                connect_args = dict(self.credentials)
+                if self.boto_profile:
+                    connect_args['profile_name'] = self.boto_profile
+                self.boto3_clients[(service, region)] = ec2_utils.boto3_inventory_conn('client', service, region,
+                                                                                       **connect_args)
+            return self.boto3_clients[(service, region)]
+
+    def get_account_id(self, region):
+        ''' Returns the id of the AWS account the credentials belong to. It
+        is looked up once and kept next to the cache, which is already
+        specific to the credentials. '''
+
+        with self.account_id_lock:
+            if self.account_id is None:
+                try:
+                    with open(self.cache_path_account, 'r') as cache:
+                        self.account_id = cache.read().strip() or None
+                except IOError:
                     pass
 
-            # ignore empty clusters caused by AWS bug
-            if len(c['DBClusterMembers']) == 0:
-                continue
-            elif matches_filter:
-                c_dict[c['DBClusterIdentifier']] = c
+            if self.account_id is None:
+                client = self.get_boto3_client('sts', region)
+                self.account_id = self.api_call('sts', region, client.get_caller_identity)['Account']
+                self.write_cache_file(self.cache_path_account, self.account_id)
+
+            return self.account_id
+
+    def add_rds_clusters(self, clusters, region):
+        ''' Adds the RDS clusters fetched for a region to the inventory '''
 
-        self.inventory['db_clusters'] = c_dict
+        self.inventory['db_clusters'] = clusters
 
     def get_elasticache_clusters_by_region(self, region):
         ''' Makes an AWS API call to the list of ElastiCache clusters (with
-        nodes' info) in a particular region.'''
+        nodes' info) in a particular region and returns them.'''
 
         # ElastiCache boto module doesn't provide a get_all_intances method,
         # that's why we need to call describe directly (it would be called by
@@ -667,7 +1776,7 @@ class Ec2Inventory(object):
             if conn:
                 # show_cache_node_info = True
                 # because we also want nodes' information
-                response = conn.describe_cache_clusters(None, None, None, True)
+                response = self.api_call('elasticache', region, conn.describe_cache_clusters, None, None, None, True)
 
         except boto.exception.BotoServerError as e:
             error = e.reason
@@ -688,12 +1797,17 @@ class Ec2Inventory(object):
             error = "ElastiCache query to AWS failed (unexpected format)."
             self.fail_with_error(error, 'getting ElastiCache clusters')
 
+        return clusters
+
+    def add_elasticache_clusters(self, clusters, region):
+        ''' Adds the ElastiCache clusters fetched for a region to the inventory '''
+
         for cluster in clusters:
             self.add_elasticache_cluster(cluster, region)
 
     def get_elasticache_replication_groups_by_region(self, region):
         ''' Makes an AWS API call to the list of ElastiCache replication groups
-        in a particular region.'''
+        in a particular region and returns them.'''
 
         # ElastiCache boto module doesn't provide a get_all_intances method,
         # that's why we need to call describe directly (it would be called by
@@ -701,7 +1815,7 @@ class Ec2Inventory(object):
         try:
             conn = self.connect_to_aws(elasticache, region)
             if conn:
-                response = conn.describe_replication_groups()
+                response = self.api_call('elasticache', region, conn.describe_replication_groups)
 
         except boto.exception.BotoServerError as e:
             error = e.reason
@@ -722,6 +1836,12 @@ class Ec2Inventory(object):
             error = "ElastiCache [Replication Groups] query to AWS failed (unexpected format)."
             self.fail_with_error(error, 'getting ElastiCache clusters')
 
+        return replication_groups
+
+    def add_elasticache_replication_groups(self, replication_groups, region):
+        ''' Adds the ElastiCache replication groups fetched for a region to the
+        inventory '''
+
         for replication_group in replication_groups:
             self.add_elasticache_replication_group(replication_group, region)
 
@@ -753,7 +1873,18 @@ class Ec2Inventory(object):
     def get_instance(self, region, instance_id):
         conn = self.connect(region)
 
-        reservations = conn.get_all_instances([instance_id])
+        reservations = self.api_call('ec2', region, conn.get_all_instances, [instance_id])
+        for reservation in reservations:
+            for instance in reservation.instances:
+                return instance
+
+    def get_instance_by_filter(self, region, filters):
+        ''' Returns the first instance in a region matching the filters, or
+        None '''
+
+        conn = self.connect(region)
+
+        reservations = self.api_call('ec2', region, conn.get_all_instances, filters=filters)
         for reservation in reservations:
             for instance in reservation.instances:
                 return instance
@@ -762,9 +1893,14 @@ class Ec2Inventory(object):
         ''' Adds an instance to the inventory and index, as long as it is
         addressable '''
 
-        # Only return instances with desired instance states
-        if instance.state not in self.ec2_instance_states:
-            return
+        record = self.get_instance_record(instance, region)
+        if record:
+            self.add_instance_record(record)
+
+    def get_instance_hostname(self, instance):
+        ''' Returns the inventory name of an instance and the address to
+        reach it at. The address is None if the instance cannot be addressed
+        (e.g. private VPC subnet). '''
 
         # Select the best destination address
         if self.destination_format and self.destination_format_tags:
@@ -779,8 +1915,7 @@ class Ec2Inventory(object):
                 dest = getattr(instance, 'tags').get(self.destination_variable, None)
 
         if not dest:
-            # Skip instances we cannot address (e.g. private VPC subnet)
-            return
+            return (None, None)
 
         # Set the inventory name
         hostname = None
@@ -796,73 +1931,117 @@ class Ec2Inventory(object):
         else:
             hostname = self.to_safe(hostname).lower()
 
+        return (hostname, dest)
+
+    def is_hostname_included(self, hostname):
+        ''' Determines if a host is let through by pattern_include and
+        pattern_exclude '''
+
         # if we only want to include hosts that match a pattern, skip those that don't
         if self.pattern_include and not self.pattern_include.match(hostname):
-            return
+            return False
 
         # if we need to exclude hosts that match a pattern, skip those
         if self.pattern_exclude and self.pattern_exclude.match(hostname):
-            return
+            return False
 
-        # Add to index
-        self.index[hostname] = [region, instance.id]
+        return True
+
+    def is_instance_skipped_before_tags(self, instance):
+        ''' Determines if an instance is certain to be left out of the
+        inventory (see get_instance_record) before its tags are fetched.
+        That is only known for the instance's state and address, and for its
+        inventory name when that does not come from its tags. '''
+
+        if instance.state not in self.ec2_instance_states:
+            return True
+
+        if self.destination_format and self.destination_format_tags:
+            return False
+        if self.hostname_variable and self.hostname_variable.startswith('tag_'):
+            return False
+        destination_variable = self.vpc_destination_variable if instance.subnet_id else self.destination_variable
+        if getattr(instance, destination_variable, None) is None:
+            # The address falls back to a tag
+            return False
+
+        (hostname, dest) = self.get_instance_hostname(instance)
+        return not hostname or not self.is_hostname_included(hostname)
+
+    def get_instance_record(self, instance, region):
+        ''' Works out where an instance goes in the inventory without touching
+        the inventory itself. Returns None if the instance is to be skipped,
+        otherwise a dict with its hostname, the group operations to replay
+        and its host variables. Only reads the instance and the settings, so
+        it can run on a worker thread. '''
+
+        # Only return instances with desired instance states
+        if instance.state not in self.ec2_instance_states:
+            return None
+
+        (hostname, dest) = self.get_instance_hostname(instance)
+        if not hostname or not self.is_hostname_included(hostname):
+            return None
+
+        # Group operations, replayed in order by add_instance_record
+        groups = []
 
         # Inventory: Group by instance ID (always a group of 1)
         if self.group_by_instance_id:
-            self.inventory[instance.id] = [hostname]
+            groups.append(['set', instance.id, hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'instances', instance.id)
+                groups.append(['push_group', 'instances', instance.id])
 
         # Inventory: Group by region
         if self.group_by_region:
-            self.push(self.inventory, region, hostname)
+            groups.append(['push', region, hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'regions', region)
+                groups.append(['push_group', 'regions', region])
 
         # Inventory: Group by availability zone
         if self.group_by_availability_zone:
-            self.push(self.inventory, instance.placement, hostname)
+            groups.append(['push', instance.placement, hostname])
             if self.nested_groups:
                 if self.group_by_region:
-                    self.push_group(self.inventory, region, instance.placement)
-                self.push_group(self.inventory, 'zones', instance.placement)
+                    groups.append(['push_group', region, instance.placement])
+                groups.append(['push_group', 'zones', instance.placement])
 
         # Inventory: Group by Amazon Machine Image (AMI) ID
         if self.group_by_ami_id:
             ami_id = self.to_safe(instance.image_id)
-            self.push(self.inventory, ami_id, hostname)
+            groups.append(['push', ami_id, hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'images', ami_id)
+                groups.append(['push_group', 'images', ami_id])
 
         # Inventory: Group by instance type
         if self.group_by_instance_type:
             type_name = self.to_safe('type_' + instance.instance_type)
-            self.push(self.inventory, type_name, hostname)
+            groups.append(['push', type_name, hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'types', type_name)
+                groups.append(['push_group', 'types', type_name])
 
         # Inventory: Group by key pair
         if self.group_by_key_pair and instance.key_name:
             key_name = self.to_safe('key_' + instance.key_name)
-            self.push(self.inventory, key_name, hostname)
+            groups.append(['push', key_name, hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'keys', key_name)
+                groups.append(['push_group', 'keys', key_name])
 
         # Inventory: Group by VPC
         if self.group_by_vpc_id and instance.vpc_id:
             vpc_id_name = self.to_safe('vpc_id_' + instance.vpc_id)
-            self.push(self.inventory, vpc_id_name, hostname)
+            groups.append(['push', vpc_id_name, hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'vpcs', vpc_id_name)
+                groups.append(['push_group', 'vpcs', vpc_id_name])
 
         # Inventory: Group by security group
         if self.group_by_security_group:
             try:
                 for group in instance.groups:
                     key = self.to_safe("security_group_" + group.name)
-                    self.push(self.inventory, key, hostname)
+                    groups.append(['push', key, hostname])
                     if self.nested_groups:
-                        self.push_group(self.inventory, 'security_groups', key)
+                        groups.append(['push_group', 'security_groups', key])
             except AttributeError:
                 self.fail_with_error('\n'.join(['Package boto seems a bit older.',
                                             'Please upgrade boto >= 2.3.0.']))
@@ -880,31 +2059,63 @@ class Ec2Inventory(object):
                         key = self.to_safe("tag_" + k + "=" + v)
                     else:
                         key = self.to_safe("tag_" + k)
-                    self.push(self.inventory, key, hostname)
+                    groups.append(['push', key, hostname])
                     if self.nested_groups:
-                        self.push_group(self.inventory, 'tags', self.to_safe("tag_" + k))
+                        groups.append(['push_group', 'tags', self.to_safe("tag_" + k)])
                         if v:
-                            self.push_group(self.inventory, self.to_safe("tag_" + k), key)
+                            groups.append(['push_group', self.to_safe("tag_" + k), key])
 
-        # Inventory: Group by Route53 domain names if enabled
+        # Inventory: Group by Route53 domain names if enabled. The records may
+        # still be loading, so only the addresses are kept and the names are
+        # looked up when the record is added.
         if self.route53_enabled and self.group_by_route53_names:
-            route53_names = self.get_instance_route53_names(instance)
-            for name in route53_names:
-                self.push(self.inventory, name, hostname)
-                if self.nested_groups:
-                    self.push_group(self.inventory, 'route53', name)
+            addresses = [getattr(instance, attrib, None) for attrib in self.route53_instance_attributes]
+            groups.append(['route53', addresses, hostname])
 
         # Global Tag: instances without tags
         if self.group_by_tag_none and len(instance.tags) == 0:
-            self.push(self.inventory, 'tag_none', hostname)
+            groups.append(['push', 'tag_none', hostname])
             if self.nested_groups:
-                self.push_group(self.inventory, 'tags', 'tag_none')
+                groups.append(['push_group', 'tags', 'tag_none'])
 
         # Global Tag: tag all EC2 instances
-        self.push(self.inventory, 'ec2', hostname)
+        groups.append(['push', 'ec2', hostname])
 
-        self.inventory["_meta"]["hostvars"][hostname] = self.get_host_info_dict_from_instance(instance)
-        self.inventory["_meta"]["hostvars"][hostname]['ansible_ssh_host'] = dest
+        hostvars = self.get_host_info_dict_from_instance(instance)
+        hostvars['ansible_ssh_host'] = dest
+
+        return {
+            'hostname': hostname,
+            'region': region,
+            'id': instance.id,
+            'launch_time': instance.launch_time,
+            'groups': groups,
+            'hostvars': hostvars,
+        }
+
+    def add_instance_record(self, record):
+        ''' Adds an instance record built by get_instance_record to the
+        inventory and index '''
+
+        hostname = record['hostname']
+
+        # Add to index
+        self.index[hostname] = [record['region'], record['id']]
+
+        for operation, key, element in record['groups']:
+            if operation == 'push':
+                self.push(self.inventory, key, element)
+            elif operation == 'push_group':
+                self.push_group(self.inventory, key, element)
+            elif operation == 'set':
+                self.inventory[key] = [element]
+            elif operation == 'route53':
+                for name in self.get_route53_names_for_addresses(key):
+                    self.push(self.inventory, name, element)
+                    if self.nested_groups:
+                        self.push_group(self.inventory, 'route53', name)
+
+        self.inventory["_meta"]["hostvars"][hostname] = record['hostvars']
 
 
     def add_rds_instance(self, instance, region):
@@ -1245,46 +2456,86 @@ class Ec2Inventory(object):
 
     def get_route53_records(self):
         ''' Get and store the map of resource records to domain names that
-        point to them. '''
+        point to them. The records of each zone are cached, and only fetched
+        again for zones whose number of record sets has changed or that were
+        fetched more than route53_cache_max_age seconds ago. '''
 
         r53_conn = route53.Route53Connection()
-        all_zones = r53_conn.get_zones()
+        all_zones = self.api_call('route53', None, r53_conn.get_zones)
 
         route53_zones = [ zone for zone in all_zones if zone.name[:-1]
                           not in self.route53_excluded_zones ]
 
-        self.route53_records = {}
+        cached_zones = {}
+        if self.route53_cache_max_age > 0 and not self.args.refresh_cache:
+            cached_zones = self.load_route53_zones()
 
+        # Route53 has no version number for a zone's records, so the number
+        # of record sets is used to notice changes, which misses a record
+        # that is changed in place until route53_cache_max_age runs out
+        now = time()
+        zones = {}
+        changed_zones = []
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            marker = getattr(zone, 'resourcerecordsetcount', None)
+            cached = cached_zones.get(zone.id)
+            if (cached and marker is not None and cached['marker'] == marker and
+                    now - cached['fetched'] < self.route53_cache_max_age):
+                zones[zone.id] = cached
+            else:
+                changed_zones.append((zone, marker))
 
-            for record_set in rrsets:
+        def get_zone_records(zone):
+            records = []
+            for record_set in self.api_call('route53', None, r53_conn.get_all_rrsets, zone.id):
                 record_name = record_set.name
 
                 if record_name.endswith('.'):
                     record_name = record_name[:-1]
 
-                for resource in record_set.resource_records:
+                records.append([record_name, list(record_set.resource_records)])
+            return records
+
+        zone_records = self.run_concurrently([(get_zone_records, (zone,)) for zone, marker in changed_zones])
+        for (zone, marker), records in zip(changed_zones, zone_records):
+            zones[zone.id] = {'marker': marker, 'fetched': now, 'records': records}
+
+        self.route53_records = {}
+
+        for zone in route53_zones:
+            for record_name, resources in zones[zone.id]['records']:
+                for resource in resources:
                     self.route53_records.setdefault(resource, set())
                     self.route53_records[resource].add(record_name)
 
+        if self.route53_cache_max_age > 0:
+            self.write_to_cache(zones, self.cache_path_route53)
+
+    def load_route53_zones(self):
+        ''' Reads the records of the Route53 zones cached by the last
+        refresh, or returns an empty dict if there are none '''
+
+        try:
+            with open(self.cache_path_route53, 'r') as cache:
+                return json.loads(cache.read())
+        except (IOError, ValueError):
+            return {}
 
     def get_instance_route53_names(self, instance):
         ''' Check if an instance is referenced in the records we have from
         Route53. If it is, return the list of domain names pointing to said
         instance. If nothing points to it, return an empty list. '''
 
-        instance_attributes = [ 'public_dns_name', 'private_dns_name',
-                                'ip_address', 'private_ip_address' ]
+        return self.get_route53_names_for_addresses(
+            [getattr(instance, attrib, None) for attrib in self.route53_instance_attributes])
 
-        name_list = set()
+    def get_route53_names_for_addresses(self, addresses):
+        ''' Return the list of domain names pointing to any of the given
+        addresses of an instance '''
 
-        for attrib in instance_attributes:
-            try:
-                value = getattr(instance, attrib)
-            except AttributeError:
-                continue
+        name_list = set()
 
+        for value in addresses:
             if value in self.route53_records:
                 name_list.update(self.route53_records[value])
 
@@ -1304,11 +2555,11 @@ class Ec2Inventory(object):
             elif key == 'ec2__previous_state':
                 instance_vars['ec2_previous_state'] = instance.previous_state or ''
                 instance_vars['ec2_previous_state_code'] = instance.previous_state_code
-            elif type(value) in [int, bool]:
+            elif type(value) in (int, bool):
                 instance_vars[key] = value
             elif isinstance(value, six.string_types):
                 instance_vars[key] = value.strip()
-            elif type(value) == type(None):
+            elif value is None:
                 instance_vars[key] = ''
             elif key == 'ec2_region':
                 instance_vars[key] = value.name
@@ -1425,21 +2676,78 @@ class Ec2Inventory(object):
     def get_host_info(self):
         ''' Get variables about a specific host '''
 
-        if len(self.index) == 0:
-            # Need to load index from cache
+        if self.inventory == self._empty_inventory():
+            host_info = self.get_cached_record('hosts', self.args.host)
+        else:
+            host_info = self.inventory["_meta"]["hostvars"].get(self.args.host)
+
+        if host_info is not None:
+            return self.json_format_dict(host_info, True)
+
+        # Not in the cache: look for just this host rather than refreshing
+        # the whole inventory. The host might not exist anymore.
+        return self.json_format_dict(self.get_host_info_from_api(self.args.host), True)
+
+    def get_host_info_from_api(self, host):
+        ''' Looks up a host that is missing from the cache with a single
+        targeted describe call per region and returns its variables, or an
+        empty dict if no instance matches '''
+
+        if len(self.index) == 0 and os.path.isfile(self.cache_path_index):
             self.load_index_from_cache()
 
-        if not self.args.host in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
-            if not self.args.host in self.index:
-                # host might not exist anymore
-                return self.json_format_dict({}, True)
+        if host in self.index:
+            (region, instance_id) = self.index[host]
+            candidates = [(region, self.get_instance(region, instance_id))]
+        else:
+            filter_key = self.get_host_filter_key(host)
+            if not filter_key:
+                return {}
+            candidates = [(region, self.get_instance_by_filter(region, {filter_key: host}))
+                          for region in self.regions]
+
+        for region, instance in candidates:
+            if instance is None:
+                continue
+            record = self.get_instance_record(instance, region)
+            if record and record['hostname'] == host:
+                return record['hostvars']
+
+        return {}
 
-        (region, instance_id) = self.index[self.args.host]
+    def get_host_filter_key(self, host):
+        ''' Works out which EC2 describe filter matches an inventory hostname,
+        based on the variable the hostnames are built from '''
 
-        instance = self.get_instance(region, instance_id)
-        return self.json_format_dict(self.get_host_info_dict_from_instance(instance), True)
+        address_filters = {
+            'public_dns_name': 'dns-name',
+            'dns_name': 'dns-name',
+            'private_dns_name': 'private-dns-name',
+            'ip_address': 'ip-address',
+            'private_ip_address': 'private-ip-address',
+        }
+
+        if self.hostname_variable:
+            if self.hostname_variable.startswith('tag_'):
+                return 'tag:' + self.hostname_variable[4:]
+            return address_filters.get(self.hostname_variable)
+
+        is_ip_address = re.match(r'^\d+\.\d+\.\d+\.\d+$', host) is not None
+        for variable in [self.vpc_destination_variable, self.destination_variable]:
+            filter_key = address_filters.get(variable)
+            if filter_key and filter_key.endswith('ip-address') == is_ip_address:
+                return filter_key
+
+        return None
+
+    def extend_hosts(self, hosts, new_hosts):
+        ''' Appends the hosts that are not in a list of hosts yet to it '''
+
+        known = set(hosts)
+        for host in new_hosts:
+            if host not in known:
+                known.add(host)
+                hosts.append(host)
 
     def push(self, my_dict, key, element):
         ''' Push an element onto an array that may not have been defined in
@@ -1460,14 +2768,254 @@ class Ec2Inventory(object):
         if element not in child_groups:
             child_groups.append(element)
 
+    def get_query_result(self, query):
+        ''' Returns the hosts matched by a group query (see query_hosts) as
+        a comma separated list, which can be passed to --limit or -i '''
+
+        (get_group, get_group_names) = self.get_group_lookup()
+        try:
+            hosts = self.query_hosts(query, get_group, get_group_names)
+        except (ValueError, re.error) as e:
+            self.fail_with_error(str(e), 'querying groups')
+
+        return ','.join(hosts) + ',' if hosts else ''
+
+    def get_group_lookup(self):
+        ''' Returns a function that looks up a group of the inventory (None if
+        there is no such group) and a function that lists the names of all
+        groups. The inventory is read from the cache unless it is in memory.
+        With the compact cache format only the groups looked up are
+        decoded. '''
+
+        inventory = self.inventory
+        if inventory == self._empty_inventory():
+            cached = None
+            if self.cache_format == 'compact':
+                cached = self.read_cached_records()
+            if cached is not None:
+                (records, offsets) = cached
+                return (lambda name: self.decode_cached_record(records, offsets, 'groups', name),
+                        lambda: list(offsets['groups']))
+            inventory = json.loads(self.get_inventory_from_cache())
+
+        return (lambda name: inventory.get(name) if name != '_meta' else None,
+                lambda: [name for name in inventory if name != '_meta'])
+
+    def query_hosts(self, query, get_group, get_group_names):
+        ''' Returns the hosts matched by a group query, in the order the
+        groups list them. A query is a list of terms separated by ':' or ','.
+        A term is a group name, or '~' followed by a regular expression that
+        is searched for in the group names (and cannot contain ':' or ',').
+        As with Ansible's host patterns, the result is the hosts in any of
+        the groups of the plain terms, that are also in the groups of every
+        term prefixed with '&', and in none of the groups of the terms
+        prefixed with '!'. Raises ValueError for a group that does not
+        exist. '''
+
+        (included, intersections, exclusions) = ([], [], [])
+        for term in re.split('[:,]', query):
+            if term.startswith('&'):
+                intersections.append(term[1:])
+            elif term.startswith('!'):
+                exclusions.append(term[1:])
+            elif term:
+                included.append(term)
+
+        if not included:
+            raise ValueError("Group query '%s' does not include any group" % query)
+
+        def get_term_hosts(term):
+            if term.startswith('~'):
+                pattern = re.compile(term[1:])
+                names = sorted(name for name in get_group_names() if pattern.search(name))
+            else:
+                names = [term]
+            hosts = []
+            for name in names:
+                hosts.extend(self.get_group_hosts(name, get_group))
+            return hosts
+
+        hosts = []
+        seen = set()
+        for term in included:
+            for host in get_term_hosts(term):
+                if host not in seen:
+                    seen.add(host)
+                    hosts.append(host)
+
+        for term in intersections:
+            term_hosts = set(get_term_hosts(term))
+            hosts = [host for host in hosts if host in term_hosts]
+
+        for term in exclusions:
+            term_hosts = set(get_term_hosts(term))
+            hosts = [host for host in hosts if host not in term_hosts]
+
+        return hosts
+
+    def get_group_hosts(self, name, get_group, parents=()):
+        ''' Returns the hosts of a group, including those of its child
+        groups. A name that is not a group is tried again with the characters
+        that are not allowed in group names replaced. '''
+
+        group = get_group(name)
+        if group is None and self.to_safe(name) != name:
+            name = self.to_safe(name)
+            group = get_group(name)
+        if group is None:
+            raise ValueError("Group '%s' is not in the inventory" % name)
+
+        if not isinstance(group, dict):
+            return group
+
+        hosts = list(group.get('hosts', []))
+        for child in group.get('children', []):
+            if child not in parents:
+                hosts.extend(self.get_group_hosts(child, get_group, parents + (name,)))
+        return hosts
+
     def get_inventory_from_cache(self):
         ''' Reads the inventory from the cache file and returns it as a JSON
         object '''
 
-        cache = open(self.cache_path_cache, 'r')
-        json_inventory = cache.read()
+        with open(self.cache_path_cache, 'rb') as cache:
+            (length, offsets_length) = self.read_cache_layout(cache)
+            json_inventory = cache.read(length).decode('utf-8')
         return json_inventory
 
+    def write_inventory_from_cache(self, output):
+        ''' Copies the inventory from the cache file to output a block at a
+        time, followed by a newline '''
+
+        output.flush()
+        output = getattr(output, 'buffer', output)
+        with open(self.cache_path_cache, 'rb') as cache:
+            (remaining, offsets_length) = self.read_cache_layout(cache)
+            while remaining:
+                block = cache.read(min(remaining, 65536))
+                if not block:
+                    break
+                output.write(block)
+                remaining -= len(block)
+        output.write(b'\n')
+        output.flush()
+
+    def read_cache_layout(self, cache):
+        ''' Returns the layout (see get_cache_layout) of an open cache file,
+        which is left at its start '''
+
+        cache.seek(0, os.SEEK_END)
+        size = cache.tell()
+        cache.seek(max(size - self.compact_cache_trailer.size, 0))
+        layout = self.get_cache_layout(cache.read(), size)
+        cache.seek(0)
+        return layout
+
+    def get_cache_layout(self, tail, size):
+        ''' Works out from the last bytes of a cache file of size bytes how
+        long the inventory's JSON at its start is, and how long the index of
+        its records that follows it is. A cache file in the json format is
+        all JSON. '''
+
+        trailer = self.compact_cache_trailer
+        if size >= trailer.size:
+            (length, offsets_length) = trailer.unpack(tail[-trailer.size:])
+            if length + offsets_length + trailer.size == size:
+                return (length, offsets_length)
+        return (size, 0)
+
+
+    def get_cache_stamp(self):
+        ''' Returns what tells the cache file written by a refresh apart from
+        any other: as it is replaced by renaming a new file over it, its inode
+        along with its size and modification time '''
+
+        stat = os.stat(self.cache_path_cache)
+        return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+    def load_instance_snapshot(self):
+        ''' Reads the instance records of the last refresh from the snapshot
+        file, and their host variables from the cache it wrote along with it.
+        Returns an empty snapshot if there is none, if it was written with
+        different settings or if the cache has been replaced since. '''
+
+        try:
+            with open(self.cache_path_snapshot, 'r') as cache:
+                snapshot = json.loads(cache.read())
+            if snapshot.get('settings') != self.settings_signature or snapshot.get('cache') != self.get_cache_stamp():
+                return {}
+            hostvars = json.loads(self.get_inventory_from_cache())['_meta']['hostvars']
+        except (OSError, IOError, ValueError, KeyError):
+            return {}
+
+        regions = snapshot.get('regions', {})
+        for instances in regions.values():
+            for instance_id, (fingerprint, record) in list(instances.items()):
+                if not record:
+                    continue
+                # Another host of the same name may have taken its place
+                record['hostvars'] = hostvars.get(record['hostname'])
+                if not record['hostvars'] or record['hostvars'].get('ec2_id') != instance_id:
+                    del instances[instance_id]
+
+        return regions
+
+    def get_cached_record(self, kind, name):
+        ''' Reads the variables of a single host (kind 'hosts') or the
+        contents of a single group (kind 'groups') from the cache. With the
+        compact cache format only that record is decoded. Returns None if it
+        is not in the cache. '''
+
+        if self.cache_format == 'compact':
+            cached = self.read_cached_records()
+            if cached is not None:
+                (records, offsets) = cached
+                try:
+                    return self.decode_cached_record(records, offsets, kind, name)
+                finally:
+                    records.close()
+
+        if not os.path.isfile(self.cache_path_cache):
+            return None
+
+        inventory = json.loads(self.get_inventory_from_cache())
+        if kind == 'hosts':
+            return inventory.get('_meta', {}).get('hostvars', {}).get(name)
+        elif name != '_meta':
+            return inventory.get(name)
+
+    def read_cached_records(self):
+        ''' Maps the compact cache into memory. Returns it along with the
+        index of where each record is, or None if it is missing, is not in the
+        compact format or cannot be read. '''
+
+        try:
+            with open(self.cache_path_cache, 'rb') as cache:
+                records = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError):
+            # Missing or empty
+            return None
+
+        (length, offsets_length) = self.get_cache_layout(records[-self.compact_cache_trailer.size:], len(records))
+        try:
+            if not offsets_length:
+                raise ValueError('No index of the records')
+            offsets = marshal.loads(records[length:length + offsets_length])
+        except (EOFError, ValueError, TypeError):
+            # In the json format, or written by another Python version
+            records.close()
+            return None
+
+        return (records, offsets)
+
+    def decode_cached_record(self, records, offsets, kind, name):
+        ''' Decodes a single record of the compact cache, or returns None if
+        there is no such record '''
+
+        if name not in offsets[kind]:
+            return None
+        (offset, length) = offsets[kind][name]
+        return json.loads(records[offset:offset + length].decode('utf-8'))
 
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
@@ -1480,10 +3028,124 @@ class Ec2Inventory(object):
     def write_to_cache(self, data, filename):
         ''' Writes data in JSON format to a file '''
 
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        json_data = self.iter_json_format_dict(data, self.cache_format == 'json')
+        self.write_cache_file(filename, json_data)
+
+    def write_compact_cache(self, inventory):
+        ''' Writes the inventory as compact JSON for --list, followed by a
+        marshalled index of where the JSON of every host's variables and of
+        every group is in it, so that a single host or group can be read
+        without decoding the rest, and by compact_cache_trailer. As they are
+        in one file, the inventory and its index are always replaced
+        together, and the inventory is only dumped once. '''
+
+        def iter_cache():
+            offsets = {'hosts': {}, 'groups': {}}
+            position = 0
+            for piece, kind, name in self.iter_json_records(inventory):
+                data = piece.encode('utf-8')
+                if kind:
+                    offsets[kind][name] = (position, len(data))
+                position += len(data)
+                yield data
+
+            offsets_data = marshal.dumps(offsets)
+            yield offsets_data
+            yield self.compact_cache_trailer.pack(position, len(offsets_data))
+
+        self.write_cache_file(self.cache_path_cache, iter_cache())
+
+    def write_fact_cache(self, inventory):
+        ''' Writes the facts about every EC2 instance that are known from the
+        API to fact_cache_path, as a file per host in the format of Ansible's
+        jsonfile fact cache. Playbooks that read that cache can then skip
+        gathering facts over SSH. Hosts that are gone are left for Ansible to
+        expire (fact_caching_timeout), as the files of the others are
+        rewritten by every refresh. '''
+
+        if not os.path.isdir(self.fact_cache_path):
+            os.makedirs(self.fact_cache_path)
+
+        for hostname, host_info in inventory['_meta']['hostvars'].items():
+            facts = self.get_host_facts(host_info)
+            if facts:
+                data = json.dumps(facts, sort_keys=True, indent=4, separators=(',', ': '))
+                self.update_fact_cache_file(os.path.join(self.fact_cache_path, hostname), data)
+
+    def update_fact_cache_file(self, filename, data):
+        ''' Writes a host's facts unless its file already holds them, in
+        which case only its modification time is updated, which is what
+        Ansible expires it by. Most instances are unchanged between refreshes,
+        and reading a small file is cheaper than replacing it. '''
+
+        try:
+            with open(filename) as facts_file:
+                unchanged = facts_file.read() == data
+        except (IOError, OSError):
+            unchanged = False
+
+        if unchanged:
+            os.utime(filename, None)
+        else:
+            self.write_cache_file(filename, data)
+
+    def get_host_facts(self, host_info):
+        ''' Returns the facts setup and ec2_metadata_facts would gather on an
+        EC2 instance that can be told from its host variables, or None for
+        hosts that are not EC2 instances (RDS, ElastiCache) '''
+
+        if not host_info.get('ec2_image_id'):
+            return None
+
+        facts = {}
+        for (fact, key) in [('ansible_ec2_instance_id', 'ec2_id'),
+                            ('ansible_ec2_ami_id', 'ec2_image_id'),
+                            ('ansible_ec2_instance_type', 'ec2_instance_type'),
+                            ('ansible_ec2_placement_availability_zone', 'ec2_placement'),
+                            ('ansible_ec2_placement_region', 'ec2_region'),
+                            ('ansible_ec2_local_ipv4', 'ec2_private_ip_address'),
+                            ('ansible_ec2_local_hostname', 'ec2_private_dns_name'),
+                            ('ansible_ec2_public_ipv4', 'ec2_ip_address'),
+                            ('ansible_ec2_public_hostname', 'ec2_public_dns_name')]:
+            if host_info.get(key):
+                facts[fact] = host_info[key]
+        if host_info.get('ec2_security_group_names'):
+            # The metadata service lists them a line each
+            facts['ansible_ec2_security_groups'] = host_info['ec2_security_group_names'].replace(',', '\n')
+
+        architecture = host_info.get('ec2_architecture')
+        if architecture:
+            facts['ansible_architecture'] = {'arm64': 'aarch64'}.get(architecture, architecture)
+        if host_info.get('ec2_private_dns_name'):
+            facts['ansible_hostname'] = host_info['ec2_private_dns_name'].split('.')[0]
+
+        return facts
+
+    def write_cache_file(self, filename, data):
+        ''' Replaces a cache file atomically: the data is written to a hidden
+        temporary file next to it, which is then renamed over it. Readers see
+        either the old or the new file, never a partly written one, and
+        directory listings (e.g. the hosts of a fact cache) skip the
+        temporary file. The data can be a string or an iterable of strings,
+        written as they come. '''
+
+        if isinstance(data, (six.text_type, six.binary_type)):
+            data = [data]
+
+        (fd, temp_filename) = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                               prefix='.%s.' % os.path.basename(filename))
+        renamed = False
+        try:
+            with os.fdopen(fd, 'wb') as cache:
+                for chunk in data:
+                    if isinstance(chunk, six.text_type):
+                        chunk = chunk.encode('utf-8')
+                    cache.write(chunk)
+            os.rename(temp_filename, filename)
+            renamed = True
+        finally:
+            if not renamed:
+                os.unlink(temp_filename)
 
     def uncammelize(self, key):
         temp = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', key)
@@ -1491,10 +3153,32 @@ class Ec2Inventory(object):
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be used as Ansible groups '''
-        regex = "[^A-Za-z0-9\_"
-        if not self.replace_dash_in_groups:
-            regex += "\-"
-        return re.sub(regex + "]", "_", word)
+        safe_word = self.safe_words.get(word)
+        if safe_word is None:
+            safe_word = self.unsafe_chars.sub("_", word)
+            # The same names are used over and over as keys of the groups
+            # and host variables, so keep a single copy of each
+            if isinstance(safe_word, str):
+                safe_word = intern(safe_word)
+            if len(self.safe_words) >= self.safe_words_max:
+                self.safe_words.clear()
+            self.safe_words[word] = safe_word
+        return safe_word
+
+    def get_launch_time_key(self, launch_time):
+        ''' Returns a key that sorts launch times in chronological order.
+        Launch times in the format AWS use are split up as they are, which is
+        much quicker than having dateutil parse them. '''
+
+        match = self.launch_time_format.match(launch_time)
+        if match:
+            (seconds, fraction) = match.groups()
+            return (seconds, (fraction or '').ljust(6, '0'))
+
+        launched = parser.parse(launch_time)
+        if launched.tzinfo is not None:
+            launched = launched.astimezone(tz.tzutc())
+        return (launched.strftime('%Y-%m-%dT%H:%M:%S'), '%06d' % launched.microsecond)
 
     def json_format_dict(self, data, pretty=False):
         ''' Converts a dict to a JSON object and dumps it as a formatted
@@ -1503,8 +3187,46 @@ class Ec2Inventory(object):
         if pretty:
             return json.dumps(data, sort_keys=True, indent=2)
         else:
-            return json.dumps(data)
+            return json.dumps(data, separators=(',', ':'))
+
+    def iter_json_format_dict(self, data, pretty=False):
+        ''' Dumps a dict like json_format_dict, but yields the JSON a piece
+        at a time: a piece per key, and per host of _meta.hostvars, so that
+        the JSON of the whole inventory is never held in memory at once.
+        Each piece is dumped by json.dumps, as json.JSONEncoder.iterencode
+        is several times slower. Pretty printed JSON is dumped in one go. '''
+
+        if pretty:
+            yield self.json_format_dict(data, True)
+            return
+
+        for piece, kind, name in self.iter_json_records(data):
+            yield piece
+
+    def iter_json_records(self, data):
+        ''' Yields the pieces of compact JSON iter_json_format_dict dumps a
+        dict in, as (piece, kind, name) tuples. The JSON of the variables of
+        a host of _meta.hostvars (kind 'hosts') and of the value of any other
+        key (kind 'groups') are pieces of their own, named after the host or
+        key; the pieces in between have no kind or name. '''
+
+        separator = '{'
+        for key, value in data.items():
+            if key == '_meta' and isinstance(value, dict) and list(value) == ['hostvars']:
+                yield (separator + '"_meta":{"hostvars":', None, None)
+                host_separator = '{'
+                for name, host_info in value['hostvars'].items():
+                    yield (host_separator + json.dumps(name) + ':', None, None)
+                    yield (self.json_format_dict(host_info), 'hosts', name)
+                    host_separator = ','
+                yield ('{}}' if host_separator == '{' else '}}', None, None)
+            else:
+                yield (separator + json.dumps(key) + ':', None, None)
+                yield (self.json_format_dict(value), 'groups', key)
+            separator = ','
+        yield ('{}' if separator == '{' else '}', None, None)
 
 
 # Run the script
-Ec2Inventory()
+if __name__ == '__main__':
+    Ec2Inventory()
@@ -4,6 +4,12 @@
 MODE=maintenance_mode_${MODE:-on}
 ENV=${ENV:-dev}
 
+# Read the facts about the EC2 instances that hosts/ec2.py writes rather than
+# gathering them all over SSH (see deploy.sh)
+export ANSIBLE_CACHE_PLUGIN=jsonfile
+export ANSIBLE_CACHE_PLUGIN_CONNECTION=${EC2_FACT_CACHE_PATH:-$HOME/.ansible/tmp/ansible-ec2-facts}
+export ANSIBLE_CACHE_PLUGIN_TIMEOUT=86400
+
 echo "Switching maintenance mode: ${MODE}"
 echo "Environment = ${ENV}"
 